@@ -3,7 +3,7 @@ import custom
 from custom.metrics import *
 from custom.criterion import SmoothCrossEntropyLoss, CustomSchedule
 from custom.config import config
-from data import Data
+from data import Data, batch_loader, build_sampler
 
 import utils
 import argparse
@@ -46,8 +46,17 @@ torch.distributed.init_process_group(backend='nccl',
 
 
 # load data
-dataset = Data(config.pickle_dir)
+dataset = Data(config.pickle_dir, cache_bytes=config.get('cache_bytes') or 0)
 print(dataset)
+sampler = build_sampler(
+    dataset, config, rank=torch.distributed.get_rank(), world_size=torch.distributed.get_world_size())
+checkpoint_path = os.path.join(args.model_dir, 'checkpoint.pth')
+dataset.warm_cache()
+loader = batch_loader(
+    dataset, sampler,
+    num_workers=config.get('num_workers') or 0,
+    prefetch_factor=config.get('prefetch_factor') or 2,
+    pin_memory=config.device.type == 'cuda')
 
 
 # load model
@@ -61,7 +70,9 @@ mt = MusicTransformer(
             num_layer=config.num_layers,
             max_seq=config.max_seq,
             dropout=config.dropout,
-            debug=config.debug, loader_path=config.load_path
+            debug=config.debug, loader_path=config.load_path,
+            attention_block=config.get('attention_block'),
+            checkpoint_every=config.get('checkpoint_every')
 )
 mt.to(config.device)
 opt = optim.Adam(mt.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9)
@@ -70,11 +81,16 @@ scheduler = CustomSchedule(config.embedding_dim, optimizer=opt)
 # Set model -> DDP
 single_mt = mt
 model, opt = amp.initialize(mt, scheduler.optimizer, opt_level="O1")
+if config.get('resume') and os.path.exists(checkpoint_path):
+    # resume mid-epoch where the last checkpoint was taken
+    utils.load_checkpoint(checkpoint_path, sampler, map_location=config.device,
+                          model=single_mt, scheduler=scheduler, amp=amp)
+    print('| resumed from {} at epoch {}, batch {}'.format(checkpoint_path, sampler.epoch, sampler.cursor))
 mt = DistributedDataParallel(model)
 
 
 metric_set = MetricsSet({
-    'accuracy': CategoricalAccuracy().cpu(),
+    'accuracy': CategoricalAccuracy(ignore_index=config.pad_token).cpu(),
     'loss': SmoothCrossEntropyLoss(config.label_smooth, config.vocab_size, config.pad_token),
     'bucket':  LogitsBucketting(config.vocab_size).cpu()
 })
@@ -93,16 +109,15 @@ eval_summary_writer = SummaryWriter(eval_log_dir)
 # Train Start
 print(">> Train start...")
 idx = 0
-for e in range(config.epochs):
+for e in range(sampler.epoch, config.epochs):
     print(">>> [Epoch was updated]")
-    for b in range(len(dataset.files) // config.batch_size):
+    train_batches = iter(loader)
+    for b in range(sampler.cursor, len(sampler)):
         scheduler.optimizer.zero_grad()
-        try:
-            batch_x, batch_y = dataset.slide_seq2seq_batch(config.batch_size, config.max_seq)
-            batch_x = torch.from_numpy(batch_x).contiguous().to(config.device, non_blocking=True, dtype=torch.int)
-            batch_y = torch.from_numpy(batch_y).contiguous().to(config.device, non_blocking=True, dtype=torch.int)
-        except IndexError:
-            continue
+        data_start_time = time.time()
+        batch_x, batch_y = next(train_batches)
+        batch_x = batch_x.to(config.device, non_blocking=True, dtype=torch.int)
+        batch_y = batch_y.to(config.device, non_blocking=True, dtype=torch.int)
 
         start_time = time.time()
         mt.train()
@@ -116,22 +131,28 @@ for e in range(config.epochs):
 
         if config.debug:
             print("[Loss]: {}".format(loss))
+            print("[Time]: data wait {:.4f}s, compute {:.4f}s".format(start_time-data_start_time, end_time-start_time))
 
         train_summary_writer.add_scalar('loss', metrics['loss'], global_step=idx)
         train_summary_writer.add_scalar('accuracy', metrics['accuracy'], global_step=idx)
         train_summary_writer.add_scalar('learning_rate', scheduler.rate(), global_step=idx)
         train_summary_writer.add_scalar('iter_p_sec', end_time-start_time, global_step=idx)
+        train_summary_writer.add_scalar('data_wait_sec', start_time-data_start_time, global_step=idx)
 
         # result_metrics = metric_set(sample, batch_y)
         if b % 100 == 0:
             single_mt.eval()
-            eval_x, eval_y = dataset.slide_seq2seq_batch(config.batch_size, config.max_seq, 'eval')
+            eval_x, eval_y = dataset.random_window_batch(config.batch_size, config.max_seq, 'eval')
             eval_x = torch.from_numpy(eval_x).contiguous().to(config.device, dtype=torch.int)
             eval_y = torch.from_numpy(eval_y).contiguous().cpu().to(config.device, dtype=torch.int)
 
             eval_preiction, weights = single_mt.forward(eval_x)
             eval_metrics = metric_set(eval_preiction.cpu(), eval_y.cpu())
             torch.save(single_mt.state_dict(), args.model_dir+'/train-{}.pth'.format(e))
+            if torch.distributed.get_rank() == 0:
+                # every rank is at the same position, one writer is enough
+                utils.save_checkpoint(checkpoint_path, sampler.state_dict(e, b + 1),
+                                      model=single_mt, scheduler=scheduler, amp=amp)
             if b == 0:
                 train_summary_writer.add_histogram("target_analysis", batch_y, global_step=e)
                 train_summary_writer.add_histogram("source_analysis", batch_x, global_step=e)
@@ -142,6 +163,10 @@ for e in range(config.epochs):
             eval_summary_writer.add_scalar('loss', eval_metrics['loss'], global_step=idx)
             eval_summary_writer.add_scalar('accuracy', eval_metrics['accuracy'], global_step=idx)
             eval_summary_writer.add_histogram("logits_bucket", eval_metrics['bucket'], global_step=idx)
+            if dataset.cache is not None:
+                # summed over the main process and the loader workers
+                for name, value in dataset.cache.stats().items():
+                    train_summary_writer.add_scalar('cache/' + name, value, global_step=idx)
 
             print('\n====================================================')
             print('Epoch/Batch: {}/{}'.format(e, b))
@@ -149,6 +174,7 @@ for e in range(config.epochs):
             print('Eval >>>> Loss: {:6.6}, Accuracy: {}'.format(eval_metrics['loss'], eval_metrics['accuracy']))
         torch.cuda.empty_cache()
         idx += 1
+    sampler.set_epoch(e + 1)
 
 torch.save(single_mt.state_dict(), args.model_dir+'/final.pth'.format(idx))
 eval_summary_writer.close()
@@ -8,7 +8,7 @@ from custom.metrics import *
 from custom.criterion import SmoothCrossEntropyLoss, CustomSchedule, TransformerLoss
 from custom.config import config
 from custom.parallel import DataParallelModel, DataParallelCriterion
-from data import Data
+from data import Data, batch_loader, build_sampler
 
 import utils
 import datetime
@@ -34,8 +34,16 @@ else:
     device_ids = None
 
 # load data
-dataset = Data(config.pickle_dir)
+dataset = Data(config.pickle_dir, cache_bytes=config.get('cache_bytes') or 0)
 print(dataset)
+sampler = build_sampler(dataset, config)
+checkpoint_path = os.path.join(args.model_dir, 'checkpoint.pth')
+dataset.warm_cache()
+loader = batch_loader(
+    dataset, sampler,
+    num_workers=config.get('num_workers') or 0,
+    prefetch_factor=config.get('prefetch_factor') or 2,
+    pin_memory=config.device.type == 'cuda')
 
 
 # load model
@@ -48,10 +56,20 @@ mt = MusicTransformer(
             num_layer=config.num_layers,
             max_seq=config.max_seq,
             dropout=config.dropout,
-            debug=config.debug, loader_path=config.load_path
+            debug=config.debug, loader_path=config.load_path,
+            attention_block=config.get('attention_block'),
+            checkpoint_every=config.get('checkpoint_every')
 )
 opt = optim.Adam(mt.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9)
 scheduler = CustomSchedule(config.embedding_dim, optimizer=opt)
+# mixed precision from config 'fp16', loss scaling for float16 only
+amp_dtype = utils.get_amp_dtype(config.get('fp16'), config.device)
+scaler = torch.amp.GradScaler(config.device.type, enabled=amp_dtype == torch.float16)
+if config.get('resume') and os.path.exists(checkpoint_path):
+    # resume mid-epoch where the last checkpoint was taken
+    utils.load_checkpoint(checkpoint_path, sampler, map_location=config.device,
+                          model=mt, scheduler=scheduler, scaler=scaler)
+    print('| resumed from {} at epoch {}, batch {}'.format(checkpoint_path, sampler.epoch, sampler.cursor))
 
 # multi-GPU set
 if torch.cuda.device_count() > 1:
@@ -63,8 +81,8 @@ else:
 
 # init metric set
 metrics_dict = {
-    'accuracy': CategoricalAccuracy(),
-    'loss': TransformerLoss(),
+    'accuracy': CategoricalAccuracy(ignore_index=config.pad_token),
+    'loss': TransformerLoss(ignore_index=config.pad_token),
     'bucket':  LogitsBucketting(config.vocab_size)
 }
 metric_set = ParallelMetricSet(metrics_dict)
@@ -85,39 +103,41 @@ eval_summary_writer = SummaryWriter(eval_log_dir)
 # Train Start
 print(">> Train start...")
 idx = 0
-for e in range(config.epochs):
+for e in range(sampler.epoch, config.epochs):
     print(">>> [Epoch was updated]")
-    for b in range(len(dataset.files) // config.batch_size):
+    train_batches = iter(loader)
+    for b in range(sampler.cursor, len(sampler)):
         scheduler.optimizer.zero_grad()
-        try:
-            batch_x, batch_y = dataset.slide_seq2seq_batch(config.batch_size, config.max_seq)
-            batch_x = torch.from_numpy(batch_x).contiguous().to(config.device, non_blocking=True, dtype=torch.int)
-            batch_y = torch.from_numpy(batch_y).contiguous().to(config.device, non_blocking=True, dtype=torch.int)
-        except IndexError:
-            continue
+        data_start_time = time.time()
+        batch_x, batch_y = next(train_batches)
+        batch_x = batch_x.to(config.device, non_blocking=True, dtype=torch.int)
+        batch_y = batch_y.to(config.device, non_blocking=True, dtype=torch.int)
 
         start_time = time.time()
         mt.train()
-        sample = mt(batch_x)
-        # pprint.pprint(sample)
-        metrics = metric_set(sample, batch_y)
+        with torch.autocast(config.device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            sample = mt(batch_x)
+            # pprint.pprint(sample)
+            metrics = metric_set(sample, batch_y)
         loss = metrics['loss']
-        loss.backward()
-        scheduler.step()
+        scaler.scale(loss).backward()
+        scheduler.step(scaler)
         end_time = time.time()
 
         if config.debug:
             print("[Loss]: {}".format(loss))
+            print("[Time]: data wait {:.4f}s, compute {:.4f}s".format(start_time-data_start_time, end_time-start_time))
 
         train_summary_writer.add_scalar('loss', metrics['loss'], global_step=idx)
         train_summary_writer.add_scalar('accuracy', metrics['accuracy'], global_step=idx)
         train_summary_writer.add_scalar('learning_rate', scheduler.rate(), global_step=idx)
         train_summary_writer.add_scalar('iter_p_sec', end_time-start_time, global_step=idx)
+        train_summary_writer.add_scalar('data_wait_sec', start_time-data_start_time, global_step=idx)
 
         # result_metrics = metric_set(sample, batch_y), run single gpu on eval time.
         if b % 100 == 0:
             single_mt.eval()
-            eval_x, eval_y = dataset.slide_seq2seq_batch(2, config.max_seq, 'eval')
+            eval_x, eval_y = dataset.random_window_batch(2, config.max_seq, 'eval')
             eval_x = torch.from_numpy(eval_x).contiguous().to(config.device, dtype=torch.int)
             eval_y = torch.from_numpy(eval_y).contiguous().to(config.device, dtype=torch.int)
 
@@ -125,6 +145,8 @@ for e in range(config.epochs):
 
             eval_metrics = eval_metric_set(eval_preiction, eval_y)
             torch.save(single_mt.state_dict(), args.model_dir+'/train-{}.pth'.format(e))
+            utils.save_checkpoint(checkpoint_path, sampler.state_dict(e, b + 1),
+                                  model=single_mt, scheduler=scheduler, scaler=scaler)
             if b == 0:
                 train_summary_writer.add_histogram("target_analysis", batch_y, global_step=e)
                 train_summary_writer.add_histogram("source_analysis", batch_x, global_step=e)
@@ -136,12 +158,17 @@ for e in range(config.epochs):
             eval_summary_writer.add_scalar('loss', eval_metrics['loss'], global_step=idx)
             eval_summary_writer.add_scalar('accuracy', eval_metrics['accuracy'], global_step=idx)
             eval_summary_writer.add_histogram("logits_bucket", eval_metrics['bucket'], global_step=idx)
+            if dataset.cache is not None:
+                # summed over the main process and the loader workers
+                for name, value in dataset.cache.stats().items():
+                    train_summary_writer.add_scalar('cache/' + name, value, global_step=idx)
 
             print('\n====================================================')
             print('Epoch/Batch: {}/{}'.format(e, b))
             print('Train >>>> Loss: {:6.6}, Accuracy: {}'.format(metrics['loss'], metrics['accuracy']))
             print('Eval >>>> Loss: {:6.6}, Accuracy: {}'.format(eval_metrics['loss'], eval_metrics['accuracy']))
         idx += 1
+    sampler.set_epoch(e + 1)
 
 torch.save(single_mt.state_dict(), args.model_dir+'/final.pth'.format(idx))
 eval_summary_writer.close()
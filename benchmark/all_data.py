@@ -0,0 +1,64 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from custom.config import config
+from data import Data
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+
+def list_all_data(dataset, mode):
+    # all_data as one python list, the way it was built before streaming
+    final_data = []
+    for fname in dataset.file_dict[mode]:
+        final_data.extend(dataset._get_seq(fname).tolist())
+        final_data.append(config.token_eos)
+    return final_data
+
+
+parser = argparse.ArgumentParser(description='Peak memory of a corpus token histogram: list vs chunks vs memmap.')
+parser.add_argument('--num_files', type=int, default=1000)
+parser.add_argument('--chunk_size', type=int, default=2 ** 20)
+args = parser.parse_args()
+
+config.load('config', ['config/base.yml'])
+
+with tempfile.TemporaryDirectory() as folder:
+    random_pickle_corpus(folder, args.num_files)
+    dataset = Data(folder)
+
+    def from_list():
+        return np.bincount(list_all_data(dataset, 'train'), minlength=config.vocab_size)
+
+    def from_chunks():
+        counts = np.zeros(config.vocab_size, dtype=np.int64)
+        for chunk in dataset.iter_all_data('train', args.chunk_size):
+            counts += np.bincount(chunk, minlength=config.vocab_size)
+        return counts
+
+    def from_memmap():
+        tokens = dataset.save_all_data(os.path.join(folder, 'train.bin'), 'train', args.chunk_size)
+        counts = np.zeros(config.vocab_size, dtype=np.int64)
+        for start in range(0, len(tokens), args.chunk_size):
+            counts += np.bincount(tokens[start:start + args.chunk_size], minlength=config.vocab_size)
+        return counts
+
+    results = {}
+    tracemalloc.start()
+    for name, fn in [('list', from_list), ('chunks', from_chunks), ('memmap', from_memmap)]:
+        tracemalloc.reset_peak()
+        start_time = time.time()
+        results[name] = fn()
+        elapsed = time.time() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        print('| {}: {:.1f}M tokens, peak {:.1f} MB, {:.2f}s'.format(
+            name, results[name].sum() / 1e6, peak / 2 ** 20, elapsed))
+    assert np.array_equal(results['list'], results['chunks']) and np.array_equal(results['list'], results['memmap'])
+    assert np.array_equal(dataset.all_data('train'), np.array(list_all_data(dataset, 'train')))
+    print('| parity: identical token counts and all_data')
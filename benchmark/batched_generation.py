@@ -0,0 +1,44 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+
+import argparse
+import random
+import time
+import torch
+
+
+parser = argparse.ArgumentParser(description='Throughput of MusicTransformer.generate_batch on CPU.')
+parser.add_argument('--batch_sizes', type=int, nargs='*', default=[1, 8, 32])
+parser.add_argument('--length', type=int, default=200, help='number of generated tokens per row')
+parser.add_argument('--embedding_dim', type=int, default=256)
+parser.add_argument('--num_layers', type=int, default=6)
+args = parser.parse_args()
+
+config.load('config', ['config/generate.yml'])
+torch.set_num_threads(os.cpu_count())
+
+mt = MusicTransformer(
+    embedding_dim=args.embedding_dim,
+    vocab_size=config.vocab_size,
+    num_layer=args.num_layers,
+    max_seq=config.max_seq,
+    dropout=0,
+    debug=False)
+mt.test()
+
+random.seed(0)
+torch.manual_seed(0)
+for batch_size in args.batch_sizes:
+    # variable-length priors, so every batch but the first needs left padding
+    priors = [[random.randrange(0, config.event_dim) for _ in range(random.randint(1, 64))]
+              for _ in range(batch_size)]
+    start_time = time.time()
+    results = mt.generate_batch(priors, args.length)
+    elapsed = time.time() - start_time
+    assert [len(r) for r in results] == [len(p) + args.length for p in priors]
+    print('| batch_size={:>3}: {:8.1f} tokens/sec ({:.2f} sec)'.format(
+        batch_size, batch_size * args.length / elapsed, elapsed), flush=True)
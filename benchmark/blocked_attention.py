@@ -0,0 +1,78 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+
+
+def build(args, attention_block, length):
+    torch.manual_seed(0)
+    return MusicTransformer(
+        embedding_dim=args.embedding_dim,
+        vocab_size=config.vocab_size,
+        num_layer=args.num_layers,
+        max_seq=length,
+        dropout=0,
+        debug=False,
+        attention_block=attention_block)
+
+
+def run(args, attention_block, length, queue):
+    config.load('config', [])
+    mt = build(args, attention_block, length)
+    x = torch.randint(0, config.event_dim, (args.batch_size, length))
+    mt.train()
+    start_time = time.time()
+    for _ in range(args.steps):
+        if args.backward:
+            mt.zero_grad()
+            mt(x).sum().backward()
+        else:
+            with torch.no_grad():
+                mt(x)
+    elapsed = (time.time() - start_time) / args.steps
+    # ru_maxrss is reported in kilobytes on linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dense vs blocked relative attention.')
+    parser.add_argument('--lengths', type=int, nargs='*', default=[512, 1024, 2048])
+    parser.add_argument('--blocks', nargs='*', default=['null', '128'])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--embedding_dim', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=6)
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--backward', action='store_true', help='time forward + backward')
+    args = parser.parse_args()
+
+    # the blocked path gives the dense output
+    config.load('config', [])
+    x = torch.randint(0, config.event_dim, (2, 300))
+    outputs = []
+    for attention_block in [None, 64]:
+        mt = build(args, attention_block, 300)
+        mt.train()
+        outputs.append(mt(x))
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-4), (outputs[0] - outputs[1]).abs().max()
+    print('| parity: max abs diff {:.2e}'.format((outputs[0] - outputs[1]).abs().max().item()))
+
+    # every run gets a fresh process, so the peak RSS belongs to that run only.
+    ctx = multiprocessing.get_context('spawn')
+    for length in args.lengths:
+        for attention_block in args.blocks:
+            attention_block = None if attention_block == 'null' else int(attention_block)
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(args, attention_block, length, queue))
+            proc.start()
+            step_time, peak = queue.get()
+            proc.join()
+            print('| L={:>5} attention_block={:>5}: {:7.3f} sec/step, peak RSS {:8.1f} MB'.format(
+                length, str(attention_block), step_time, peak), flush=True)
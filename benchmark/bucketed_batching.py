@@ -0,0 +1,64 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss
+from data import Data, WindowSampler, LengthBucketSampler, batch_loader
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import tempfile
+import time
+import torch
+
+
+parser = argparse.ArgumentParser(description='token-budget length-bucketed batches vs fixed max_seq windows.')
+parser.add_argument('--num_files', type=int, default=300)
+parser.add_argument('--max_seq', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--steps', type=int, default=20)
+args = parser.parse_args()
+
+config.load('config', ['config/base.yml'])
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+torch.manual_seed(0)
+
+mt = MusicTransformer(embedding_dim=128, vocab_size=config.vocab_size, num_layer=2,
+                      max_seq=args.max_seq, dropout=0.1, debug=False).to(device)
+mt.train()
+opt = torch.optim.Adam(mt.parameters(), lr=1e-4)
+criterion = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+
+with tempfile.TemporaryDirectory() as folder:
+    # many pieces shorter than max_seq, as kept by preprocess.py --min_length
+    random_pickle_corpus(folder, args.num_files, min_length=50, max_length=4 * args.max_seq)
+    dataset = Data(folder)
+    corpus_tokens = sum(dataset.seq_length(fname) for fname in dataset.file_dict['train'])
+
+    samplers = {
+        'fixed': WindowSampler(dataset, args.batch_size, args.max_seq),
+        'bucketed': LengthBucketSampler(dataset, args.batch_size * args.max_seq, args.max_seq),
+    }
+    for name, sampler in samplers.items():
+        epoch_tokens = sum(num_tokens - 1 for batch in sampler for _, _, num_tokens in batch)
+        real_tokens, padded_tokens = 0, 0
+        elapsed = 0.
+        for step, (batch_x, batch_y) in enumerate(batch_loader(dataset, sampler)):
+            if step == args.steps:
+                break
+            batch_x = batch_x.to(device, dtype=torch.int)
+            batch_y = batch_y.to(device, dtype=torch.int)
+            start_time = time.time()
+            opt.zero_grad()
+            loss = criterion(mt(batch_x), batch_y)
+            loss.backward()
+            opt.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.time() - start_time
+            real_tokens += int((batch_y != config.pad_token).sum())
+            padded_tokens += batch_y.numel()
+        print('| {}: {} batches/epoch, {:.0%} of the corpus per epoch, padding {:.1%}, {:.0f} tokens/sec'.format(
+            name, len(sampler), epoch_tokens / corpus_tokens, 1 - real_tokens / padded_tokens, real_tokens / elapsed))
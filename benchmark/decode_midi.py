@@ -0,0 +1,55 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from midi_processor.processor import Event, _event_seq2snote_seq, _merge_note, decode_midi, encode_midi
+from benchmark.synthetic import random_midi_corpus
+
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+import numpy as np
+import pretty_midi
+
+
+def reference_decode_midi(idx_array):
+    # decode_midi before it was vectorized
+    event_sequence = [Event.from_int(idx) for idx in idx_array]
+    snote_seq = _event_seq2snote_seq(event_sequence)
+    note_seq = _merge_note(snote_seq)
+    note_seq.sort(key=lambda x: x.start)
+    mid = pretty_midi.PrettyMIDI()
+    instument = pretty_midi.Instrument(1, False, "Developed By Yang-Kichang")
+    instument.notes = note_seq
+    mid.instruments.append(instument)
+    return mid
+
+
+def note_tuples(mid):
+    return [(n.velocity, n.pitch, n.start, n.end) for n in mid.instruments[0].notes]
+
+
+parser = argparse.ArgumentParser(description='Array decode_midi vs the per-event object path.')
+parser.add_argument('--num_sequences', type=int, default=200, help='generated-like random sequences')
+parser.add_argument('--length', type=int, default=2048)
+parser.add_argument('--num_files', type=int, default=10, help='encoded synthetic midi files')
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+# random tokens behave like an untrained model: unmatched note_offs, repeated note_ons, pads
+sequences = [rng.integers(0, 391, args.length).tolist() for _ in range(args.num_sequences)]
+with tempfile.TemporaryDirectory() as folder:
+    sequences += [encode_midi(path) for path in random_midi_corpus(folder, args.num_files, 1000)]
+
+results = {}
+for name, decode in [('object', reference_decode_midi), ('array', decode_midi)]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.time()
+        results[name] = [note_tuples(decode(seq)) for seq in sequences]
+        elapsed = time.time() - start_time
+    print('| {}: {:.1f} sequences/sec'.format(name, len(sequences) / elapsed))
+
+assert results['object'] == results['array']
+print('| parity: {} sequences, {} notes identical'.format(len(sequences), sum(map(len, results['array']))))
@@ -0,0 +1,96 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from midi_processor.processor import _control_preprocess, _note_preprocess, _divide_note, \
+    _make_time_sift_events, _snote2events, encode_midi, encode_note_arrays
+from benchmark.synthetic import random_midi_corpus
+
+import argparse
+import random
+import tempfile
+import time
+import pretty_midi
+
+
+def reference_encode_notes(notes):
+    # the event loop of encode_midi before it was vectorized
+    events = []
+    dnotes = _divide_note(notes)
+    dnotes.sort(key=lambda x: x.time)
+    cur_time = 0
+    cur_vel = 0
+    for snote in dnotes:
+        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
+        events += _snote2events(snote=snote, prev_vel=cur_vel)
+        cur_time = snote.time
+        cur_vel = snote.velocity
+    return [e.to_int() for e in events]
+
+
+def reference_encode_midi(file_path):
+    notes = []
+    mid = pretty_midi.PrettyMIDI(midi_file=file_path)
+    for inst in mid.instruments:
+        ctrls = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
+        notes += _note_preprocess(ctrls, inst.notes)
+    return reference_encode_notes(notes)
+
+
+def grid_notes(num_notes, seed):
+    # times on a 5ms grid: equal times and exact .5 rounding ties, velocities around the // 4 quirk
+    rng = random.Random(seed)
+    notes = []
+    for _ in range(num_notes):
+        start = rng.randrange(0, 400) * 0.005
+        notes.append(pretty_midi.Note(rng.choice([0, 1, 3, 4, 5, 64, 127]), rng.randrange(128),
+                                      start, start + rng.randrange(0, 500) * 0.005))
+    return notes
+
+
+parser = argparse.ArgumentParser(description='Array encode_midi vs the per-event object path.')
+parser.add_argument('--num_files', type=int, default=50)
+parser.add_argument('--num_notes', type=int, default=2000)
+parser.add_argument('--midi_dir', default=None, help='check and time a real corpus instead of synthetic files')
+args = parser.parse_args()
+
+# golden check: identical tokens
+for seed in range(200):
+    notes = grid_notes(300, seed)
+    expected = reference_encode_notes(list(notes))
+    tokens = encode_note_arrays([n.start for n in notes], [n.end for n in notes],
+                                [n.pitch for n in notes], [n.velocity for n in notes]).tolist()
+    assert tokens == expected, seed
+print('| parity: 200 note grids identical')
+
+with tempfile.TemporaryDirectory() as folder:
+    if args.midi_dir is None:
+        paths = random_midi_corpus(os.path.join(folder, 'plain'), args.num_files // 2, args.num_notes)
+        paths += random_midi_corpus(os.path.join(folder, 'pedal'), args.num_files - args.num_files // 2,
+                                    args.num_notes, pedal=True)
+    else:
+        paths = [os.path.join(root, f) for root, _, files in os.walk(args.midi_dir)
+                 for f in files if f.endswith(('.mid', '.midi'))]
+
+    results = {}
+    for name, encode in [('object', reference_encode_midi), ('array', encode_midi)]:
+        start_time = time.time()
+        results[name] = [encode(path) for path in paths]
+        print('| {}: {:.1f} files/sec'.format(name, len(paths) / (time.time() - start_time)))
+    assert results['object'] == results['array']
+    print('| parity: {} files identical'.format(len(paths)))
+
+    # the encoding alone, without midi parsing
+    midis = [pretty_midi.PrettyMIDI(path) for path in paths]
+    note_lists = [[n for inst in mid.instruments for n in inst.notes] for mid in midis]
+    start_time = time.time()
+    for notes in note_lists:
+        reference_encode_notes(list(notes))
+    object_time = time.time() - start_time
+    start_time = time.time()
+    for notes in note_lists:
+        encode_note_arrays([n.start for n in notes], [n.end for n in notes],
+                           [n.pitch for n in notes], [n.velocity for n in notes])
+    array_time = time.time() - start_time
+    print('| encoding only: object {:.1f} files/sec, array {:.1f} files/sec'.format(
+        len(paths) / object_time, len(paths) / array_time))
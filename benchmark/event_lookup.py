@@ -0,0 +1,62 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from midi_processor.processor import RANGE_NOTE_ON, RANGE_NOTE_OFF, RANGE_TIME_SHIFT, EVENT_TYPES, \
+    Event, classify_events, decode_midi
+
+import argparse
+import contextlib
+import io
+import time
+import numpy as np
+
+
+def reference_type_check(int_value):
+    # Event._type_check before the lookup table
+    range_note_on = range(0, RANGE_NOTE_ON)
+    range_note_off = range(RANGE_NOTE_ON, RANGE_NOTE_ON+RANGE_NOTE_OFF)
+    range_time_shift = range(RANGE_NOTE_ON+RANGE_NOTE_OFF, RANGE_NOTE_ON+RANGE_NOTE_OFF+RANGE_TIME_SHIFT)
+    valid_value = int_value
+    if int_value in range_note_on:
+        return {'type': 'note_on', 'value': valid_value}
+    elif int_value in range_note_off:
+        valid_value -= RANGE_NOTE_ON
+        return {'type': 'note_off', 'value': valid_value}
+    elif int_value in range_time_shift:
+        valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF)
+        return {'type': 'time_shift', 'value': valid_value}
+    else:
+        valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_TIME_SHIFT)
+        return {'type': 'velocity', 'value': valid_value}
+
+
+def reference_from_int(int_value):
+    info = reference_type_check(int_value)
+    return Event(info['type'], info['value'])
+
+
+parser = argparse.ArgumentParser(description='Lookup-table event classification on a long token stream.')
+parser.add_argument('--length', type=int, default=1000000)
+args = parser.parse_args()
+
+# parity over the vocabulary, pads and out of range values
+tokens = list(range(-10, 600))
+types, values = classify_events(tokens)
+for idx, t, v in zip(tokens, types, values):
+    expected = reference_type_check(idx)
+    assert Event._type_check(idx) == expected
+    assert (EVENT_TYPES[t], v) == (expected['type'], expected['value'])
+print('| parity: {} tokens classified identically'.format(len(tokens)))
+
+stream = np.random.default_rng(0).integers(0, 391, args.length)
+stream_list = stream.tolist()
+for name, fn in [('range checks', lambda: [reference_from_int(idx) for idx in stream_list]),
+                 ('lookup table', lambda: [Event.from_int(idx) for idx in stream_list]),
+                 ('classify_events', lambda: classify_events(stream)),
+                 ('decode_midi', lambda: decode_midi(stream_list))]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.time()
+        fn()
+        elapsed = time.time() - start_time
+    print('| {}: {:.2f}M tokens/sec'.format(name, args.length / elapsed / 1e6))
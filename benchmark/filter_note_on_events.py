@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from preprocess import filter_note_on_events
+from midi_processor.processor import START_IDX, encode_midi
+from benchmark.synthetic import random_midi_corpus
+
+import argparse
+import tempfile
+import time
+import numpy as np
+
+
+def reference_filter_note_on_events(temp_data):
+    # filter_note_on_events before it was vectorized
+    current_note_on_events = []
+    current_note_off_events = []
+    temp_events = []
+    filtered_events = []         # The final list of events (filtered and non-filtered)
+    time_shift_total = 0
+
+    for idx in temp_data:
+        # Check if the event is a 'note_on' or 'note_off' event
+        if idx in np.arange(START_IDX['note_on'], START_IDX['note_off']):
+            current_note_on_events.append(idx)
+
+        elif idx in np.arange(START_IDX['note_off'], START_IDX['time_shift']):
+            current_note_off_events.append(idx)
+
+        if idx not in np.arange(START_IDX['time_shift'], START_IDX['velocity']):
+            temp_events.append(idx)
+
+        # Check if the event is a 'time_shift' event (or indicates the end of the group)
+        else:
+            time_shift_total += idx - START_IDX['time_shift']
+            # Process current_note_on_events before a time shift event
+            if current_note_on_events and time_shift_total >= 5:
+                average_note_on = np.mean(current_note_on_events)  # Calculate average
+                # Filter note_on events that are above the average
+                filtered_notes = [note for note in temp_events if note > average_note_on - 1]
+                filtered_events.extend(filtered_notes)  # Add filtered note_on events to final list
+                current_note_on_events = []  # Reset for the next group of note_on events
+                temp_events = []
+                time_shift_total = 0
+
+            elif current_note_on_events:
+                temp_events.append(idx)
+
+            # Add the time_shift event itself to the filtered list
+            # filtered_events.append(idx)
+
+    # Edge case: Handle remaining note_on events if no final time_shift is present
+    if current_note_on_events:
+        average_note_on = np.mean(current_note_on_events)
+        filtered_note_on = [note for note in current_note_on_events if note > average_note_on]
+        filtered_events.extend(filtered_note_on)
+
+    return filtered_events
+
+
+parser = argparse.ArgumentParser(description='Array filter_note_on_events vs the per-token loop.')
+parser.add_argument('--length', type=int, default=100000, help='tokens of the timed piece')
+parser.add_argument('--num_files', type=int, default=4)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+sequences = [rng.integers(0, 388, 2000).tolist() for _ in range(20)]
+# mostly notes and short time shifts, so groups are long and the tail is not empty
+sequences += [rng.choice([rng.integers(0, 128), rng.integers(128, 256), rng.integers(256, 259), 370],
+                         p=[0.4, 0.3, 0.25, 0.05], size=500).tolist() for _ in range(20)]
+sequences += [[], [256, 300], [60, 64, 67], [60, 256, 64, 260, 70, 66, 356]]
+with tempfile.TemporaryDirectory() as folder:
+    pieces = [encode_midi(path) for path in random_midi_corpus(folder, args.num_files, 3000)]
+sequences += pieces
+for seq in sequences:
+    assert filter_note_on_events(seq) == reference_filter_note_on_events(seq), seq
+print('| parity: {} sequences identical'.format(len(sequences)))
+
+piece = [idx for p in pieces for idx in p]
+piece = (piece * (args.length // len(piece) + 1))[:args.length]
+for name, fn in [('loop', reference_filter_note_on_events), ('array', filter_note_on_events)]:
+    start_time = time.time()
+    fn(piece)
+    elapsed = time.time() - start_time
+    print('| {}: {:.0f} tokens/sec ( {:.3f}s for {} tokens )'.format(name, args.length / elapsed, elapsed, args.length))
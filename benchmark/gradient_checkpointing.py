@@ -0,0 +1,68 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss
+
+import argparse
+import warnings
+import multiprocessing
+import resource
+import time
+import torch
+
+
+def run(args, checkpoint_every, queue):
+    # torch.utils.checkpoint still calls torch.cpu.amp.autocast internally
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    config.load('config', ['config/base.yml'])
+    torch.manual_seed(0)
+    mt = MusicTransformer(embedding_dim=args.embedding_dim, vocab_size=config.vocab_size, num_layer=args.num_layers,
+                          max_seq=args.length, dropout=0.1, debug=False, checkpoint_every=checkpoint_every)
+    mt.train()
+    criterion = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+    batch = torch.randint(0, config.event_dim, (args.batch_size, args.length + 1))
+    x, y = batch[:, :-1].int(), batch[:, 1:].int()
+
+    # ru_maxrss is reported in kilobytes on linux
+    setup_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    elapsed = 0.
+    for step in range(args.steps + 1):
+        mt.zero_grad()
+        # same dropout masks in every run
+        torch.manual_seed(step)
+        start_time = time.time()
+        criterion(mt(x), y).backward()
+        if step > 0:
+            elapsed += time.time() - start_time
+    # numpy copies, torch tensors would be passed back through shared memory of the exiting process
+    grads = [p.grad.numpy().copy() for p in mt.parameters()]
+    queue.put((elapsed / args.steps, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - setup_peak, grads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory and step time against checkpoint granularity.')
+    parser.add_argument('--checkpoint_every', nargs='*', default=['none', '1', '2', '3', '6'])
+    parser.add_argument('--embedding_dim', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=6)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=2)
+    args = parser.parse_args()
+
+    # every run gets a fresh process, so the peak RSS belongs to that run only.
+    ctx = multiprocessing.get_context('spawn')
+    reference = None
+    for every in args.checkpoint_every:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run, args=(args, None if every == 'none' else int(every), queue))
+        proc.start()
+        step_time, peak, grads = queue.get()
+        proc.join()
+        if reference is None:
+            reference = grads
+        diff = max(abs(g - r).max() for g, r in zip(grads, reference))
+        print('| checkpoint_every={:>4}: {:.2f} s/step, peak RSS growth over setup {:6.0f} MB, max grad diff {:.1e}'.format(
+            every, step_time, peak, diff), flush=True)
@@ -0,0 +1,88 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.layers import RelativeGlobalAttention
+import utils
+
+import argparse
+import time
+import torch
+from torch.profiler import profile, record_function, ProfilerActivity
+
+
+def legacy_get_masked_with_pad_tensor(size, src, trg, pad_token):
+    # utils.get_masked_with_pad_tensor before the mask cache
+    src = src[:, None, None, :]
+    trg = trg[:, None, None, :]
+    src_pad_tensor = torch.ones_like(src).to(src.device.type) * pad_token
+    src_mask = torch.equal(src, src_pad_tensor)
+    trg_mask = torch.equal(src, src_pad_tensor)
+    trg_pad_tensor = torch.ones_like(trg).to(trg.device.type) * pad_token
+    dec_trg_mask = trg == trg_pad_tensor
+    seq_mask = ~utils.sequence_mask(torch.arange(1, size+1).to(trg.device), size)
+    look_ahead_mask = dec_trg_mask | seq_mask
+    return src_mask, trg_mask, look_ahead_mask
+
+
+def legacy_qe_masking(qe):
+    # RelativeGlobalAttention._qe_masking before the mask cache
+    mask = utils.sequence_mask(
+        torch.arange(qe.size()[-1] - 1, qe.size()[-1] - qe.size()[-2] - 1, -1).to(qe.device),
+        qe.size()[-1])
+    mask = ~mask.to(mask.device)
+    return mask.to(qe.dtype) * qe
+
+
+def recorded(fn):
+    def wrapper(*args, **kwargs):
+        with record_function('mask_functions'):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+parser = argparse.ArgumentParser(description='Share of step time spent building masks.')
+parser.add_argument('--length', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=2)
+parser.add_argument('--embedding_dim', type=int, default=256)
+parser.add_argument('--num_layers', type=int, default=6)
+parser.add_argument('--steps', type=int, default=5)
+args = parser.parse_args()
+
+config.load('config', [])
+torch.manual_seed(0)
+mt = MusicTransformer(
+    embedding_dim=args.embedding_dim,
+    vocab_size=config.vocab_size,
+    num_layer=args.num_layers,
+    max_seq=args.length,
+    dropout=0,
+    debug=False)
+mt.train()
+x = torch.randint(0, config.event_dim, (args.batch_size, args.length))
+x[0, -10:] = config.pad_token
+
+variants = {
+    'before': (legacy_get_masked_with_pad_tensor, legacy_qe_masking),
+    'after': (utils.get_masked_with_pad_tensor, RelativeGlobalAttention._qe_masking),
+}
+outputs = {}
+for name, (get_masked_with_pad_tensor, qe_masking) in variants.items():
+    utils.get_masked_with_pad_tensor = recorded(get_masked_with_pad_tensor)
+    RelativeGlobalAttention._qe_masking = staticmethod(recorded(qe_masking))
+    mt(x).sum().backward()  # warm up ( and fill the cache )
+    with profile(activities=[ProfilerActivity.CPU]) as prof:
+        start_time = time.time()
+        for _ in range(args.steps):
+            mt.zero_grad()
+            out = mt(x)
+            out.sum().backward()
+        elapsed = time.time() - start_time
+    outputs[name] = out.detach()
+    mask_time = sum(e.cpu_time_total for e in prof.key_averages() if e.key == 'mask_functions') / 1e6
+    print('| {:>6}: {:.3f} sec/step, mask functions {:.4f} sec/step ({:.2f}% of the step)'.format(
+        name, elapsed / args.steps, mask_time / args.steps, 100 * mask_time / elapsed), flush=True)
+
+assert torch.equal(outputs['before'], outputs['after'])
@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss, CustomSchedule
+import utils
+
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+
+
+def run(args, embedding_dim, fp16, queue):
+    config.load('config', ['config/base.yml'])
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    mt = MusicTransformer(embedding_dim=embedding_dim, vocab_size=config.vocab_size, num_layer=args.num_layers,
+                          max_seq=args.length, dropout=0.1, debug=False)
+    mt.train()
+    opt = torch.optim.Adam(mt.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9)
+    scheduler = CustomSchedule(embedding_dim, optimizer=opt)
+    criterion = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+    amp_dtype = utils.get_amp_dtype(fp16, device)
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    batch = torch.randint(0, config.event_dim, (args.batch_size, args.length + 1))
+    x, y = batch[:, :-1].int(), batch[:, 1:].int()
+    losses = []
+    elapsed = 0.
+    for step in range(args.steps + 1):
+        start_time = time.time()
+        opt.zero_grad()
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            loss = criterion(mt(x), y)
+        scaler.scale(loss).backward()
+        scheduler.step(scaler)
+        if step > 0:
+            # the first step warms up the allocator and kernels
+            elapsed += time.time() - start_time
+        losses.append(loss.item())
+    # ru_maxrss is reported in kilobytes on linux
+    queue.put((elapsed / args.steps, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, losses))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU bfloat16 autocast vs float32 training steps.')
+    parser.add_argument('--embedding_dims', type=int, nargs='*', default=[256, 512])
+    parser.add_argument('--num_layers', type=int, default=6)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=3)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    for embedding_dim in args.embedding_dims:
+        for fp16 in [None, 'bf16']:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(args, embedding_dim, fp16, queue))
+            proc.start()
+            step_time, peak, losses = queue.get()
+            proc.join()
+            print('| embedding_dim={} {}: {:.2f} s/step, peak RSS {:.0f} MB, loss {:.4f} -> {:.4f}'.format(
+                embedding_dim, 'bf16' if fp16 else 'fp32', step_time, peak, losses[0], losses[-1]), flush=True)
@@ -0,0 +1,52 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+import custom.layers
+
+import argparse
+import math as m
+import time
+import numpy as np
+import torch
+
+
+class LegacyDynamicPositionEmbedding(torch.nn.Module):
+    # DynamicPositionEmbedding before the vectorized table
+    def __init__(self, embedding_dim, max_seq=2048):
+        super().__init__()
+        embed_sinusoid_list = np.array([[
+            [
+                m.sin(
+                    pos * m.exp(-m.log(10000) * i/embedding_dim) *
+                    m.exp(m.log(10000)/embedding_dim * (i % 2)) + 0.5 * m.pi * (i % 2)
+                )
+                for i in range(embedding_dim)
+            ]
+            for pos in range(max_seq)
+        ]])
+        self.positional_embedding = embed_sinusoid_list
+
+    def forward(self, x, offset=0):
+        return x + torch.from_numpy(
+            self.positional_embedding[:, offset:offset + x.size(1), :]).to(x.device, dtype=x.dtype)
+
+
+parser = argparse.ArgumentParser(description='MusicTransformer construction time.')
+parser.add_argument('--embedding_dims', type=int, nargs='*', default=[256, 512])
+parser.add_argument('--max_seq', type=int, default=2048)
+args = parser.parse_args()
+
+current = custom.layers.DynamicPositionEmbedding
+for embedding_dim in args.embedding_dims:
+    tables = {}
+    for name, embedding in [('before', LegacyDynamicPositionEmbedding), ('after', current)]:
+        custom.layers.DynamicPositionEmbedding = embedding
+        start_time = time.time()
+        mt = MusicTransformer(embedding_dim=embedding_dim, max_seq=args.max_seq)
+        elapsed = time.time() - start_time
+        x = torch.zeros(1, args.max_seq, embedding_dim)
+        tables[name] = mt.Decoder.pos_encoding(x)
+        print('| embedding_dim={} {:>6}: {:.3f} sec'.format(embedding_dim, name, elapsed), flush=True)
+    assert torch.equal(tables['before'], tables['after'])
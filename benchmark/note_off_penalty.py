@@ -0,0 +1,100 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss
+from midi_processor.processor import START_IDX, encode_midi
+from synthetic import random_midi_corpus
+
+import argparse
+import tempfile
+import time
+import torch
+
+
+def loop_penalty(self, target):
+    # SmoothCrossEntropyLoss._apply_note_off_penalty before it was vectorized
+    penalty = 0.0
+    batch_size, seq_length = target.shape
+    for b in range(batch_size):
+        last_note_on_time = [-1] * START_IDX['note_off']
+        prev_was_velocity = False
+        for t in range(seq_length):
+            token = target[b, t]
+            if self.note_on_idx <= token < self.note_off_idx:
+                if last_note_on_time[token] != -1:
+                    penalty += 1.0
+                last_note_on_time[token] = t
+            if self.note_off_idx <= token < self.time_shift_idx:
+                if last_note_on_time[token - self.note_off_idx] == -1:
+                    penalty += 1.0
+                elif t - last_note_on_time[token - self.note_off_idx] > 50:
+                    penalty += 1.0
+                last_note_on_time[token - self.note_off_idx] = -1
+            if token == 256:
+                penalty += 1.0
+            # padding is not a velocity
+            if self.velocity_idx <= token and token != self.ignore_index:
+                if prev_was_velocity:
+                    penalty += 1.0
+                else:
+                    prev_was_velocity = True
+            else:
+                prev_was_velocity = False
+    return penalty
+
+
+parser = argparse.ArgumentParser(description='Vectorized vs loop note-off penalty.')
+parser.add_argument('--batch_size', type=int, default=2)
+parser.add_argument('--length', type=int, default=2048)
+parser.add_argument('--embedding_dim', type=int, default=256)
+parser.add_argument('--num_layers', type=int, default=6)
+parser.add_argument('--steps', type=int, default=3)
+args = parser.parse_args()
+
+config.load('config', [])
+loss = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+
+# equivalence on random tokens and on encoded midi
+torch.manual_seed(0)
+targets = [torch.randint(0, config.vocab_size, (args.batch_size, 300)) for _ in range(5)]
+# few distinct tokens, so pitches repeat and the > 50 rule triggers
+targets += [torch.randint(0, 4, (args.batch_size, 300)) * 128 + torch.randint(0, 3, (args.batch_size, 300))
+            for _ in range(5)]
+with tempfile.TemporaryDirectory() as folder:
+    for path in random_midi_corpus(folder, 4, num_notes=300):
+        tokens = encode_midi(path)[:args.length]
+        targets.append(torch.tensor([tokens, tokens[::-1]]))
+for target in targets:
+    expected = loop_penalty(loss, target)
+    assert loss._apply_note_off_penalty(target).item() == expected, expected
+print('| equivalence: {} batches identical to the loop'.format(len(targets)))
+
+mt = MusicTransformer(
+    embedding_dim=args.embedding_dim,
+    vocab_size=config.vocab_size,
+    num_layer=args.num_layers,
+    max_seq=args.length,
+    dropout=0,
+    debug=False)
+mt.train()
+x = torch.randint(0, config.event_dim, (args.batch_size, args.length))
+y = torch.randint(0, config.event_dim, (args.batch_size, args.length))
+penalties = {
+    'no penalty': lambda self, target: 0.0,
+    'loop': loop_penalty,
+    'vectorized': SmoothCrossEntropyLoss._apply_note_off_penalty,
+}
+for name, penalty in penalties.items():
+    SmoothCrossEntropyLoss._apply_note_off_penalty = penalty
+    start_time = time.time()
+    for _ in range(args.steps):
+        mt.zero_grad()
+        loss(mt(x), y).backward()
+    elapsed = (time.time() - start_time) / args.steps
+    start_time = time.time()
+    penalty(loss, y)
+    penalty_time = time.time() - start_time
+    print('| {:>10}: {:.3f} sec/step, penalty alone {:.4f} sec'.format(name, elapsed, penalty_time), flush=True)
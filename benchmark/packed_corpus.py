@@ -0,0 +1,50 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from data import Data, pack_pickles
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import random
+import tempfile
+import time
+import numpy as np
+
+
+parser = argparse.ArgumentParser(description='slide_seq2seq_batch throughput, per-file pickles vs packed corpus.')
+parser.add_argument('--num_files', type=int, default=10000)
+parser.add_argument('--batch_size', type=int, default=2)
+parser.add_argument('--length', type=int, default=2048)
+parser.add_argument('--num_batches', type=int, default=500)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as folder:
+    pickle_dir = os.path.join(folder, 'pickle')
+    packed_dir = os.path.join(folder, 'packed')
+    start_time = time.time()
+    random_pickle_corpus(pickle_dir, args.num_files, min_length=args.length + 100, max_length=3 * args.length)
+    print('| wrote {} pickles in {:.1f}s'.format(args.num_files, time.time() - start_time))
+    start_time = time.time()
+    num_files, num_tokens = pack_pickles(pickle_dir, packed_dir)
+    print('| packed {} files, {} tokens in {:.1f}s'.format(num_files, num_tokens, time.time() - start_time))
+
+    results = {}
+    for name, dir_path in [('pickle', pickle_dir), ('packed', packed_dir)]:
+        start_time = time.time()
+        dataset = Data(dir_path)
+        open_time = time.time() - start_time
+        random.seed(args.seed)
+        batches = []
+        start_time = time.time()
+        for _ in range(args.num_batches):
+            batches.append(dataset.slide_seq2seq_batch(args.batch_size, args.length))
+        elapsed = time.time() - start_time
+        results[name] = batches
+        print('| {}: open {:.2f}s, {:.1f} batches/sec'.format(name, open_time, args.num_batches / elapsed))
+
+    # same seed, same files and windows
+    for (x, y), (px, py) in zip(results['pickle'], results['packed']):
+        assert np.array_equal(x, px) and np.array_equal(y, py) and px.dtype == np.int64
+    print('| parity: {} batches identical'.format(args.num_batches))
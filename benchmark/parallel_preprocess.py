@@ -0,0 +1,40 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from preprocess import preprocess_midi_files_under
+from benchmark.synthetic import random_midi_corpus
+
+import argparse
+import tempfile
+import time
+
+
+parser = argparse.ArgumentParser(description='preprocessing files/sec from 1 to N worker processes.')
+parser.add_argument('--num_files', type=int, default=200)
+parser.add_argument('--num_notes', type=int, default=1000)
+parser.add_argument('--max_workers', type=int, default=os.cpu_count())
+parser.add_argument('--chunksize', type=int, default=4)
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as folder:
+    midi_dir = os.path.join(folder, 'midi')
+    random_midi_corpus(midi_dir, args.num_files, args.num_notes)
+    # a truncated file, reported as a failure instead of stopping the run
+    with open(os.path.join(midi_dir, 'broken.mid'), 'wb') as f:
+        f.write(b'MThd\x00\x00')
+
+    num_workers = 1
+    while num_workers <= args.max_workers:
+        out_dir = os.path.join(folder, 'out_{}'.format(num_workers))
+        start_time = time.time()
+        failures = preprocess_midi_files_under(midi_dir, out_dir, num_workers, args.chunksize)
+        elapsed = time.time() - start_time
+        assert len(failures) == 1
+        print('| workers={}: {:.1f} files/sec'.format(num_workers, (args.num_files + 1) / elapsed))
+        num_workers *= 2
+
+    # resume: everything but the failed file is skipped
+    start_time = time.time()
+    preprocess_midi_files_under(midi_dir, out_dir, args.max_workers, args.chunksize)
+    print('| re-run: {:.2f}s'.format(time.time() - start_time))
@@ -0,0 +1,62 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss
+from data import Data, WindowSampler, batch_loader
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import tempfile
+import time
+import torch
+
+
+parser = argparse.ArgumentParser(description='data wait vs compute time per training step, with and without prefetching.')
+parser.add_argument('--num_files', type=int, default=500)
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--length', type=int, default=512)
+parser.add_argument('--steps', type=int, default=30)
+parser.add_argument('--num_workers', type=int, default=2)
+parser.add_argument('--prefetch_factor', type=int, default=4)
+args = parser.parse_args()
+
+config.load('config', ['config/base.yml'])
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+torch.manual_seed(0)
+
+mt = MusicTransformer(embedding_dim=128, vocab_size=config.vocab_size, num_layer=2,
+                      max_seq=args.length, dropout=0.1, debug=False).to(device)
+mt.train()
+opt = torch.optim.Adam(mt.parameters(), lr=1e-4)
+criterion = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+
+with tempfile.TemporaryDirectory() as folder:
+    random_pickle_corpus(folder, args.num_files, min_length=args.length + 100, max_length=8 * args.length)
+    dataset = Data(folder)
+    sampler = WindowSampler(dataset, args.batch_size, args.length)
+    for num_workers in [0, args.num_workers]:
+        batches = iter(batch_loader(dataset, sampler, num_workers=num_workers,
+                                    prefetch_factor=args.prefetch_factor, pin_memory=device.type == 'cuda'))
+        next(batches)  # worker start-up is not part of a step
+        data_wait, compute = 0., 0.
+        for _ in range(args.steps):
+            data_start_time = time.time()
+            batch_x, batch_y = next(batches)
+            batch_x = batch_x.to(device, non_blocking=True, dtype=torch.int)
+            batch_y = batch_y.to(device, non_blocking=True, dtype=torch.int)
+            start_time = time.time()
+            opt.zero_grad()
+            loss = criterion(mt(batch_x), batch_y)
+            loss.backward()
+            opt.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            end_time = time.time()
+            data_wait += start_time - data_start_time
+            compute += end_time - start_time
+        print('| num_workers={}: data wait {:.2f}ms, compute {:.2f}ms per step'.format(
+            num_workers, 1000 * data_wait / args.steps, 1000 * compute / args.steps))
+        del batches
@@ -0,0 +1,49 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from custom.sampler import GreedySampler, TemperatureSampler, TopKSampler, TopPSampler
+
+import argparse
+import timeit
+import torch
+import torch.distributions as dist
+
+
+def one_hot_categorical(logits):
+    # the sampling step generate() used before custom.sampler
+    pdf = dist.OneHotCategorical(probs=logits.softmax(-1))
+    return pdf.sample().argmax(-1).unsqueeze(-1)
+
+
+parser = argparse.ArgumentParser(description='Per-step sampling overhead.')
+parser.add_argument('--vocab_size', type=int, default=391)
+parser.add_argument('--batch_sizes', type=int, nargs='*', default=[1, 8, 32, 64])
+parser.add_argument('--number', type=int, default=2000)
+args = parser.parse_args()
+
+samplers = {
+    'one_hot_categorical': one_hot_categorical,
+    'greedy': GreedySampler(),
+    'temperature': TemperatureSampler(0.9),
+    'top_k': TopKSampler(32),
+    'top_p': TopPSampler(0.9),
+}
+
+torch.manual_seed(0)
+for batch_size in args.batch_sizes:
+    logits = torch.randn(batch_size, args.vocab_size)
+    for name, sampler in samplers.items():
+        sample = sampler(logits)
+        assert sample.shape == (batch_size, 1)
+        elapsed = timeit.timeit(lambda: sampler(logits), number=args.number)
+        print('| batch_size={:>3} {:>20}: {:7.1f} us/step'.format(
+            batch_size, name, elapsed / args.number * 1e6), flush=True)
+
+# with temperature 1, TemperatureSampler draws from the same distribution as before.
+logits = torch.randn(4, args.vocab_size)
+torch.manual_seed(0)
+old = torch.cat([one_hot_categorical(logits) for _ in range(100)], -1)
+torch.manual_seed(0)
+new = torch.cat([TemperatureSampler()(logits) for _ in range(100)], -1)
+print('| same draws as OneHotCategorical under one seed: {}'.format(torch.equal(old, new)))
@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from data import Data
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import random
+import tempfile
+import time
+import numpy as np
+
+
+# Data.random_sequential_batch and Data.sequential_batch before the strided views
+def reference_random_sequential_batch(self, batch_size, length):
+    batch_files = random.sample(self.files, k=batch_size)
+    batch_data = []
+    for i in range(batch_size):
+        data = self._get_seq(batch_files[i])
+        for j in range(len(data) - length):
+            batch_data.append(data[j:j+length])
+            if len(batch_data) == batch_size:
+                return batch_data
+
+
+
+def reference_sequential_batch(self, batch_size, length):
+    batch_data = []
+    data = self._get_seq(self.files[self._seq_file_name_idx])
+
+    while len(batch_data) < batch_size:
+        while self._seq_idx < len(data) - length:
+            batch_data.append(data[self._seq_idx: self._seq_idx + length])
+            self._seq_idx += 1
+            if len(batch_data) == batch_size:
+                return batch_data
+
+        self._seq_idx = 0
+        self._seq_file_name_idx = self._seq_file_name_idx + 1
+        if self._seq_file_name_idx == len(self.files):
+            self._seq_file_name_idx = 0
+            print('iter intialized')
+
+
+parser = argparse.ArgumentParser(description='Strided window batches vs per-window list slices.')
+parser.add_argument('--num_files', type=int, default=100)
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--length', type=int, default=2048)
+parser.add_argument('--num_batches', type=int, default=200)
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as folder:
+    random_pickle_corpus(folder, args.num_files, min_length=args.length + 10, max_length=3 * args.length)
+    dataset = Data(folder)
+
+    # parity with stride 1. the old sequential_batch never reloaded after the first file,
+    # so it is compared while the first file lasts.
+    for seed in range(20):
+        random.seed(seed)
+        expected = np.array(reference_random_sequential_batch(dataset, args.batch_size, args.length))
+        random.seed(seed)
+        assert np.array_equal(dataset.random_sequential_batch(args.batch_size, args.length), expected)
+    first_file_windows = dataset.seq_length(dataset.files[0]) - args.length
+    reference, strided = Data(folder), Data(folder)
+    for _ in range(first_file_windows // args.batch_size):
+        assert np.array_equal(strided.sequential_batch(args.batch_size, args.length),
+                              np.array(reference_sequential_batch(reference, args.batch_size, args.length)))
+    print('| parity: identical windows')
+
+    for name, fn in [
+            ('random_sequential_batch, per-window slices', lambda d: np.array(reference_random_sequential_batch(d, args.batch_size, args.length))),
+            ('random_sequential_batch, strided', lambda d: d.random_sequential_batch(args.batch_size, args.length)),
+            ('sequential_batch, per-window slices', lambda d: np.array(reference_sequential_batch(d, args.batch_size, args.length))),
+            ('sequential_batch, strided', lambda d: d.sequential_batch(args.batch_size, args.length)),
+            ('sequential_batch, strided, stride=length', lambda d: d.sequential_batch(args.batch_size, args.length, args.length))]:
+        d = Data(folder)
+        random.seed(0)
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            start_time = time.time()
+            for _ in range(args.num_batches):
+                fn(d)
+            elapsed = time.time() - start_time
+            sys.stdout = stdout
+        print('| {}: {:.0f} windows/sec'.format(name, args.num_batches * args.batch_size / elapsed))
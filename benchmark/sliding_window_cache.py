@@ -0,0 +1,52 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+
+
+def run(args, window, length, queue):
+    config.load('config', ['config/generate.yml', 'cache_window={}'.format(window)])
+    mt = MusicTransformer(
+        embedding_dim=args.embedding_dim,
+        vocab_size=config.vocab_size,
+        num_layer=args.num_layers,
+        max_seq=config.max_seq,
+        dropout=0,
+        debug=False)
+    mt.test()
+    torch.manual_seed(0)
+    start_time = time.time()
+    mt.generate(torch.tensor([[24, 28, 31]]), length)
+    elapsed = time.time() - start_time
+    # ru_maxrss is reported in kilobytes on linux
+    queue.put((elapsed / length, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ring-buffer KV cache vs threshold_len recompute.')
+    parser.add_argument('--lengths', type=int, nargs='*', default=[1000, 4000, 16000])
+    parser.add_argument('--windows', nargs='*', default=['499', 'null'],
+                        help="cache_window values, 'null' recomputes the window on every truncation")
+    parser.add_argument('--embedding_dim', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=6)
+    args = parser.parse_args()
+
+    # every run gets a fresh process, so the peak RSS belongs to that run only.
+    ctx = multiprocessing.get_context('spawn')
+    for window in args.windows:
+        for length in args.lengths:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(args, window, length, queue))
+            proc.start()
+            latency, peak = queue.get()
+            proc.join()
+            print('| cache_window={:>5} length={:>6}: {:7.2f} ms/token, peak RSS {:8.1f} MB'.format(
+                window, length, latency * 1000, peak), flush=True)
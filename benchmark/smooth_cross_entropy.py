@@ -0,0 +1,79 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from custom.config import config
+from custom.criterion import SmoothCrossEntropyLoss
+
+import argparse
+import multiprocessing
+import resource
+import torch
+import torch.nn.functional as F
+
+
+def legacy_cross_entropy(self, input, target):
+    # SmoothCrossEntropyLoss.forward before it stopped building the smoothed targets ( without the penalty )
+    mask = (target == self.ignore_index).unsqueeze(-1)
+    q = F.one_hot(target.long(), self.vocab_size).type(torch.float32)
+    u = 1.0 / self.vocab_size
+    q_prime = (1.0 - self.label_smoothing) * q + self.label_smoothing * u
+    q_prime = q_prime.masked_fill(mask, 0)
+    ce = -torch.sum(q_prime * (input - input.logsumexp(dim=-1, keepdim=True)), dim=-1)
+    return ce.sum() / torch.sum(target != self.ignore_index)
+
+
+def current_cross_entropy(self, input, target):
+    penalty = self._apply_note_off_penalty
+    self._apply_note_off_penalty = lambda target: 0.0
+    loss = self(input, target)
+    self._apply_note_off_penalty = penalty
+    return loss
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def run(name, args, queue):
+    config.load('config', [])
+    loss = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+    torch.manual_seed(0)
+    input = torch.randn(args.batch_size, args.length, config.vocab_size, requires_grad=True)
+    target = torch.randint(0, config.vocab_size, (args.batch_size, args.length))
+    before = rss_mb()
+    fn = legacy_cross_entropy if name == 'legacy' else current_cross_entropy
+    fn(loss, input, target).backward()
+    # ru_maxrss is reported in kilobytes on linux
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Label-smoothed cross entropy: parity and peak memory.')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--length', type=int, default=2048)
+    args = parser.parse_args()
+
+    config.load('config', [])
+    loss = SmoothCrossEntropyLoss(0.1, config.vocab_size, config.pad_token)
+    torch.manual_seed(0)
+    input = torch.randn(4, 100, config.vocab_size, dtype=torch.float64, requires_grad=True)
+    target = torch.randint(0, config.vocab_size, (4, 100))
+    target[:, -20:] = config.pad_token
+    expected = legacy_cross_entropy(loss, input, target)
+    result = current_cross_entropy(loss, input, target)
+    grads = [torch.autograd.grad(value, input)[0] for value in (expected, result)]
+    assert torch.allclose(expected, result) and torch.allclose(*grads)
+    print('| parity: loss {:.6f} vs {:.6f}, max grad diff {:.2e}'.format(
+        expected.item(), result.item(), (grads[0] - grads[1]).abs().max().item()))
+
+    ctx = multiprocessing.get_context('spawn')
+    for name in ['legacy', 'current']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run, args=(name, args, queue))
+        proc.start()
+        peak = queue.get()
+        proc.join()
+        print('| {:>7}: peak memory above inputs {:8.1f} MB (B={}, T={})'.format(
+            name, peak, args.batch_size, args.length), flush=True)
@@ -0,0 +1,60 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from model import MusicTransformer
+from custom.config import config
+from midi_processor.processor import decode_midi
+
+import argparse
+import time
+import torch
+
+
+parser = argparse.ArgumentParser(description='Time to first note of generate_stream vs generate.')
+parser.add_argument('--length', type=int, default=1000, help='number of generated tokens')
+parser.add_argument('--embedding_dim', type=int, default=256)
+parser.add_argument('--num_layers', type=int, default=6)
+args = parser.parse_args()
+
+config.load('config', ['config/generate.yml'])
+
+mt = MusicTransformer(
+    embedding_dim=args.embedding_dim,
+    vocab_size=config.vocab_size,
+    num_layer=args.num_layers,
+    max_seq=config.max_seq,
+    dropout=0,
+    debug=False)
+mt.test()
+# a prior that keeps a few notes open, so notes complete early in the stream
+prior = torch.tensor([[24, 28, 31, 300, 152, 156, 300]])
+
+torch.manual_seed(0)
+start_time = time.time()
+tokens = mt.generate(prior, args.length).tolist()
+whole_piece = time.time() - start_time
+
+torch.manual_seed(0)
+start_time = time.time()
+first_event = first_note = None
+events, notes = [], []
+for event, completed in mt.generate_stream(prior, args.length, decode=True):
+    if first_event is None:
+        first_event = time.time() - start_time
+    if completed and first_note is None:
+        first_note = time.time() - start_time
+    events.append(event)
+    notes += completed
+
+print('| whole piece: {:.3f} sec'.format(whole_piece))
+print('| stream: first event {:.3f} sec, first note {} sec'.format(
+    first_event, 'n/a' if first_note is None else '{:.3f}'.format(first_note)))
+
+# the streamed notes are exactly the notes decode_midi finds in the final token list
+assert prior[0].tolist() + events == tokens
+notes.sort(key=lambda x: x.start)
+expected = decode_midi(tokens).instruments[0].notes
+key = lambda note: (note.velocity, note.pitch, note.start, note.end)
+assert [key(n) for n in notes] == [key(n) for n in expected]
+print('| parity: {} notes identical to decode_midi'.format(len(notes)))
@@ -0,0 +1,100 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from midi_processor.processor import SustainDownManager, _control_preprocess, _note_preprocess
+from benchmark.synthetic import random_midi
+
+import argparse
+import copy
+import random
+import tempfile
+import time
+import pretty_midi
+
+
+def reference_note_preprocess(susteins, notes):
+    # _note_preprocess before the sort-and-sweep
+    note_stream = []
+
+    if susteins:    # if the midi file has sustain controls
+        for sustain in susteins:
+            for note_idx, note in enumerate(notes):
+                if note.start < sustain.start:
+                    note_stream.append(note)
+                elif note.start > sustain.end:
+                    notes = notes[note_idx:]
+                    sustain.transposition_notes()
+                    break
+                else:
+                    sustain.add_managed_note(note)
+
+        for sustain in susteins:
+            note_stream += sustain.managed_notes
+    
+    else:       # else, just push everything into note stream
+        for note_idx, note in enumerate(notes):
+            note_stream.append(note)
+
+    note_stream.sort(key= lambda x: x.start)
+    return note_stream
+
+
+
+
+def note_tuples(notes):
+    return [(id(n), n.velocity, n.pitch, n.start, n.end) for n in notes]
+
+
+def run(preprocess, notes, sustains):
+    # both versions mutate the notes and the sustains, so each gets its own copy.
+    # ids are mapped back to positions in the input list to compare duplicates too.
+    notes, sustains = copy.deepcopy((notes, sustains))
+    position = {id(n): i for i, n in enumerate(notes)}
+    return [(position[i],) + tuple(rest) for i, *rest in note_tuples(preprocess(sustains, notes))]
+
+
+def random_case(rng, num_notes, num_sustains):
+    notes = []
+    for _ in range(num_notes):
+        start = rng.randrange(0, 200) * 0.05
+        notes.append(pretty_midi.Note(rng.randrange(128), rng.randrange(21, 30), start, start + rng.uniform(0.01, 2)))
+    # list order is not start order, as in pretty_midi
+    notes.sort(key=lambda n: n.end)
+    sustains = []
+    for _ in range(num_sustains):
+        s = rng.randrange(0, 200) * 0.05
+        sustains.append(SustainDownManager(s, s + rng.choice([0., 0.05, 1., 3., 20.])))
+    if rng.random() < 0.7:
+        sustains.sort(key=lambda x: x.start)
+    return notes, sustains
+
+
+parser = argparse.ArgumentParser(description='Sort-and-sweep sustain preprocessing vs the rescanning loop.')
+parser.add_argument('--num_notes', type=int, default=20000)
+parser.add_argument('--num_files', type=int, default=3)
+args = parser.parse_args()
+
+# parity on small random cases: sustains that never stop, decreasing ends, duplicate starts, no notes
+rng = random.Random(0)
+for case in range(500):
+    notes, sustains = random_case(rng, rng.randrange(0, 60), rng.randrange(1, 8))
+    assert run(_note_preprocess, notes, sustains) == run(reference_note_preprocess, notes, sustains), case
+print('| parity: 500 random cases identical')
+
+with tempfile.TemporaryDirectory() as folder:
+    for i in range(args.num_files):
+        path = random_midi(os.path.join(folder, '{}.mid'.format(i)), args.num_notes, pedal=True, seed=i)
+        inst = pretty_midi.PrettyMIDI(path).instruments[0]
+        sustains = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
+        timings = {}
+        results = {}
+        for name, fn in [('loop', reference_note_preprocess), ('sweep', _note_preprocess)]:
+            notes, sus = copy.deepcopy((inst.notes, sustains))
+            start_time = time.time()
+            result = fn(sus, notes)
+            timings[name] = time.time() - start_time
+            results[name] = [(n.velocity, n.pitch, n.start, n.end) for n in result]
+        assert results['loop'] == results['sweep']
+        print('| {} notes, {} sustains: loop {:.3f}s, sweep {:.3f}s, identical'.format(
+            len(inst.notes), len(sustains), timings['loop'], timings['sweep']))
@@ -0,0 +1,52 @@
+"""
+synthetic inputs for the benchmarks, when no real dataset is at hand.
+"""
+import os
+import pickle
+import random
+
+import numpy as np
+import pretty_midi
+
+
+def random_midi(file_path, num_notes=500, pedal=False, seed=None):
+    """
+    writes a piano piece of overlapping random notes, with sustain pedal changes if pedal is set.
+    """
+    rng = random.Random(seed)
+    mid = pretty_midi.PrettyMIDI()
+    inst = pretty_midi.Instrument(0)
+    time = 0.
+    for _ in range(num_notes):
+        time += rng.choice([0., 0., 0.01, 0.05, 0.1, 0.25, 0.5, 1.3])
+        duration = rng.uniform(0.02, 2.)
+        inst.notes.append(pretty_midi.Note(rng.randrange(1, 128), rng.randrange(21, 109), time, time + duration))
+    if pedal:
+        pedal_time = 0.
+        while pedal_time < time:
+            pedal_time += rng.uniform(0.05, 1.)
+            inst.control_changes.append(pretty_midi.ControlChange(64, 127, pedal_time))
+            pedal_time += rng.uniform(0.05, 1.)
+            inst.control_changes.append(pretty_midi.ControlChange(64, 0, pedal_time))
+    mid.instruments.append(inst)
+    mid.write(file_path)
+    return file_path
+
+
+def random_midi_corpus(folder, num_files, num_notes=500, pedal=False):
+    os.makedirs(folder, exist_ok=True)
+    return [random_midi(os.path.join(folder, '{:05d}.mid'.format(i)), num_notes, pedal, seed=i)
+            for i in range(num_files)]
+
+
+def random_pickle_corpus(folder, num_files, min_length=2100, max_length=6000, vocab_size=388):
+    """
+    writes token lists the way preprocess.py does, one pickle per piece.
+    """
+    rng = np.random.default_rng(0)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(num_files):
+        data = rng.integers(vocab_size, size=rng.integers(min_length, max_length + 1)).tolist()
+        with open(os.path.join(folder, '{:05d}.mid.pickle'.format(i)), 'wb') as f:
+            pickle.dump(data, f)
+    return folder
@@ -0,0 +1,43 @@
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from data import Data
+from benchmark.synthetic import random_pickle_corpus
+
+import argparse
+import random
+import tempfile
+import time
+import numpy as np
+
+
+parser = argparse.ArgumentParser(description='Data LRU cache: hit rate and batches/sec against cache size.')
+parser.add_argument('--num_files', type=int, default=2000)
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--length', type=int, default=2048)
+parser.add_argument('--num_batches', type=int, default=1000)
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as folder:
+    random_pickle_corpus(folder, args.num_files, min_length=args.length + 100, max_length=3 * args.length)
+    uncached = Data(folder)
+    # the cache keeps uint16 tokens, 2 bytes each
+    corpus_bytes = 2 * sum(uncached.seq_length(fname) for fname in uncached.file_dict['train'])
+    print('| train split: {:.1f} MB as uint16'.format(corpus_bytes / 2 ** 20))
+
+    reference = None
+    for fraction in [0, 0.1, 0.25, 0.5, 1.0]:
+        dataset = Data(folder, cache_bytes=int(fraction * corpus_bytes))
+        random.seed(0)
+        batches = []
+        start_time = time.time()
+        for _ in range(args.num_batches):
+            batches.append(dataset.slide_seq2seq_batch(args.batch_size, args.length))
+        elapsed = time.time() - start_time
+        if reference is None:
+            reference = batches
+        assert all(np.array_equal(x, rx) and np.array_equal(y, ry) for (x, y), (rx, ry) in zip(batches, reference))
+        stats = dataset.cache.stats() if dataset.cache else {'hit_rate': 0., 'evictions': 0}
+        print('| cache {:4.0%} of the split: hit rate {:5.1%}, {} evictions, {:.1f} batches/sec'.format(
+            fraction, stats['hit_rate'], stats['evictions'], args.num_batches / elapsed))
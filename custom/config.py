@@ -31,6 +31,9 @@ class Config:
     def __getitem__(self, key):
         return self.dict[key]
 
+    def get(self, key, default=None):
+        return self.dict.get(key, default)
+
     def load(self, model_dir, configs, initialize=False, print=True):
         save_config_file = os.path.join(model_dir, self.CONFIG_FILE_NAME)
         if os.path.exists(save_config_file):
@@ -17,7 +17,8 @@ class TransformerLoss(CrossEntropyLoss):
         target = target.to(torch.long)
         mask = (target != self.ignore_index).to(input.device, dtype=torch.long)
         not_masked_length = mask.to(torch.int).sum()
-        input = input.permute(0, -1, -2)
+        # at least float32: dpc.py runs the criterion in parallel threads, outside autocast
+        input = input.to(torch.promote_types(input.dtype, torch.float32)).permute(0, -1, -2)
         _loss = super().forward(input, target)
         _loss *= mask.to(_loss.dtype)
         return _loss.sum() / not_masked_length
@@ -53,15 +54,16 @@ class SmoothCrossEntropyLoss(_Loss):
         Returns:
             cross entropy: [1]
         """
-        # Smooth the target distribution
-        mask = (target == self.ignore_index).unsqueeze(-1)
-        q = F.one_hot(target.long(), self.vocab_size).type(torch.float32)
-        u = 1.0 / self.vocab_size
-        q_prime = (1.0 - self.label_smoothing) * q + self.label_smoothing * u
-        q_prime = q_prime.masked_fill(mask, 0)
-
-        # Standard cross-entropy loss
-        ce = self.cross_entropy_with_logits(q_prime, input)
+        # Cross entropy against the smoothed target distribution
+        # (1 - label_smoothing) * one_hot(target) + label_smoothing / vocab_size,
+        # without materialising it: the one-hot term is a gather, the uniform term a sum.
+        mask = target == self.ignore_index
+        # at least float32 also under autocast, the sums over the vocabulary need the precision
+        log_probs = F.log_softmax(input, dim=-1, dtype=torch.promote_types(input.dtype, torch.float32))
+        target_log_probs = log_probs.gather(-1, target.long().masked_fill(mask, 0).unsqueeze(-1)).squeeze(-1)
+        ce = -((1.0 - self.label_smoothing) * target_log_probs
+               + self.label_smoothing / self.vocab_size * log_probs.sum(dim=-1))
+        ce = ce.masked_fill(mask, 0)
 
         # Apply the penalty for missing Note-Off events within 50 MIDI events
         penalty = self._apply_note_off_penalty(target)
@@ -78,68 +80,42 @@ class SmoothCrossEntropyLoss(_Loss):
     def _apply_note_off_penalty(self, target):
         """
         Penalty for missing Note-Off after a Note-On event within 50 events.
+        Counts, per sequence:
+            NoteOn of a pitch that is already on, NoteOff without NoteOn,
+            NoteOff more than 50 events after its NoteOn, zero time shifts
+            and velocity events directly following another velocity event.
+        Computed with batched tensor operations, so nothing is read back from the device.
         """
-        penalty = 0.0
+        target = target.long()
         batch_size, seq_length = target.shape
-
-        # Iterate through each sequence in the batch
-        for b in range(batch_size):
-            last_note_on_time = [-1] * START_IDX['note_off']
-            prev_was_velocity = False
-            for t in range(seq_length):
-                # window = target[b, t : min(t+50, len(t)-1)]
-                token = target[b, t]
-
-                # If NoteOn event
-                if self.note_on_idx <= token < self.note_off_idx:
-                    # NoteON event multiple times before NoteOff
-                    if last_note_on_time[token] is not -1:
-                        penalty += 1.0
-                    last_note_on_time[token] = t
-                
-                # If NoteOff event
-                if self.note_off_idx <= token < self.time_shift_idx:
-                    # NoteOff event without NoteOn
-                    if last_note_on_time[token - self.note_off_idx] == -1:
-                        penalty += 1.0
-                    # NoteOn event was > 50 tokens ago
-                    elif t - last_note_on_time[token - self.note_off_idx] > 50:
-                        penalty += 1.0
-                    last_note_on_time[token - self.note_off_idx] = -1
-
-                # Timeshift = 0
-                if token == 256:
-                    penalty += 1.0
-
-                # Two immediately following velocity shifts
-                if self.velocity_idx <= token:
-                    if prev_was_velocity:
-                        penalty += 1.0
-                    else:
-                        prev_was_velocity = True
-                else:
-                    prev_was_velocity = False
-
-                # # Detect Note-On event
-                # if self.note_on_idx <= token < self.note_off_idx:
-                #     note_on_positions.append(t)
-
-                # # Apply penalty if there's no corresponding Note-Off within 50 tokens
-                # if len(note_on_positions) > 0:
-                #     if token >= self.note_off_idx and token < self.time_shift_idx and token == note_on_positions[0] + START_IDX['note off']:  # Note-Off event
-                #         note_on_positions.pop(0)  # Remove first Note-On as it is paired
-                #     elif t - note_on_positions[0] > 50:  # Check if 50 tokens have passed
-                #         penalty += 1.0  # Add penalty for each unpaired Note-On
-                #         note_on_positions.pop(0)  # Remove the unpaired Note-On event
-        
-        return penalty
-
-    def cross_entropy_with_logits(self, p, q):
-        """
-        Standard cross-entropy calculation with logits.
-        """
-        return -torch.sum(p * (q - q.logsumexp(dim=-1, keepdim=True)), dim=-1)
-
+        num_pitch = self.note_off_idx - self.note_on_idx
+        time = torch.arange(seq_length, device=target.device).expand(batch_size, seq_length)
+        row = torch.arange(batch_size, device=target.device).unsqueeze(-1)
+
+        is_on = (self.note_on_idx <= target) & (target < self.note_off_idx)
+        is_off = (self.note_off_idx <= target) & (target < self.time_shift_idx)
+
+        # line up the note events of every (sequence, pitch) in time order.
+        # any other token gets a group of its own, so it never follows a NoteOn.
+        pitch = torch.where(is_on, target - self.note_on_idx, target - self.note_off_idx)
+        group = torch.where(is_on | is_off, row * num_pitch + pitch, batch_size * num_pitch + row * seq_length + time)
+        order = (group * seq_length + time).flatten().argsort()
+        group, time, is_on, is_off = [t.flatten()[order] for t in (group, time, is_on, is_off)]
+
+        first = torch.zeros(1, dtype=torch.bool, device=target.device)
+        after_on = torch.cat([first, (group[1:] == group[:-1]) & is_on[:-1]])
+        late = torch.cat([first, (time[1:] - time[:-1]) > 50])
+
+        # NoteON event multiple times before NoteOff
+        penalty = (is_on & after_on).sum()
+        # NoteOff event without NoteOn, or NoteOn event was > 50 tokens ago
+        penalty += (is_off & (~after_on | late)).sum()
+        # Timeshift = 0
+        penalty += (target == self.time_shift_idx).sum()
+        # Two immediately following velocity shifts, padding is not a velocity
+        velocity = (self.velocity_idx <= target) & (target != self.ignore_index)
+        penalty += (velocity[:, 1:] & velocity[:, :-1]).sum()
+        return penalty.to(torch.float32)
 
 
 class CustomSchedule:
@@ -153,14 +129,26 @@ class CustomSchedule:
         self._step = 0
         self._rate = 0
 
-    def step(self):
-        "Update parameters and rate"
+    def step(self, scaler=None):
+        "Update parameters and rate, through the GradScaler if given"
         self._step += 1
         rate = self.rate()
         for p in self.optimizer.param_groups:
             p['lr'] = rate
         self._rate = rate
-        self.optimizer.step()
+        if scaler is None:
+            self.optimizer.step()
+        else:
+            scaler.step(self.optimizer)
+            scaler.update()
+
+    def state_dict(self):
+        return {'step': self._step, 'rate': self._rate, 'optimizer': self.optimizer.state_dict()}
+
+    def load_state_dict(self, state):
+        self._step = state['step']
+        self._rate = state['rate']
+        self.optimizer.load_state_dict(state['optimizer'])
 
     def rate(self, step=None):
         if step is None:
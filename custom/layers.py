@@ -5,50 +5,136 @@ import numpy as np
 import math
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def sinusoid(max_seq, embedding_dim):
-    return np.array([[
-        [
-            m.sin(
-                pos * m.exp(-m.log(10000) * i / embedding_dim) * m.exp(
-                    m.log(10000) / embedding_dim * (i % 2)) + 0.5 * m.pi * (i % 2)
-            )
-            for i in range(embedding_dim)
-        ]
-        for pos in range(max_seq)
-    ]])
+    return _sinusoid_table(max_seq, embedding_dim).unsqueeze(0).numpy()
+
+
+def _sinusoid_table(max_seq, embedding_dim, device=None):
+    """
+    :return: [max_seq, embedding_dim] float64 table, same values as the former per-element math.sin loop
+    """
+    pos = torch.arange(max_seq, dtype=torch.float64, device=device).unsqueeze(-1)
+    i = torch.arange(embedding_dim, dtype=torch.float64, device=device)
+    odd = i % 2
+    freq = torch.exp(-m.log(10000) * i / embedding_dim) * torch.exp(m.log(10000) / embedding_dim * odd)
+    return torch.sin(pos * freq + 0.5 * m.pi * odd)
 
 
 class DynamicPositionEmbedding(torch.nn.Module):
     def __init__(self, embedding_dim, max_seq=2048):
         super().__init__()
-        embed_sinusoid_list = np.array([[
-            [
-                m.sin(
-                    pos * m.exp(-m.log(10000) * i/embedding_dim) *
-                    m.exp(m.log(10000)/embedding_dim * (i % 2)) + 0.5 * m.pi * (i % 2)
-                )
-                for i in range(embedding_dim)
-            ]
-            for pos in range(max_seq)
-        ]])
-        self.positional_embedding = embed_sinusoid_list
-
-    def forward(self, x):
-        x = x + torch.from_numpy(self.positional_embedding[:, :x.size(1), :]).to(x.device, dtype=x.dtype)
+        self.embedding_dim = embedding_dim
+        # not persistent: it is rebuilt from its size, so checkpoints stay as they were.
+        self.register_buffer(
+            'positional_embedding',
+            _sinusoid_table(max_seq, embedding_dim).to(torch.get_default_dtype()).unsqueeze(0),
+            persistent=False)
+
+    def forward(self, x, offset=0):
+        """
+        :param offset: position of x[:, 0], or a tensor of positions per row ( [batch] )
+        """
+        if isinstance(offset, torch.Tensor):
+            positions = (offset.unsqueeze(-1) + torch.arange(x.size(1), device=offset.device)).clamp(min=0)
+            self._extend(int(positions.max()) + 1)
+            return x + self.positional_embedding[0].to(x.device, dtype=x.dtype)[positions]
+        self._extend(offset + x.size(1))
+        x = x + self.positional_embedding[:, offset:offset + x.size(1), :].to(x.device, dtype=x.dtype)
         return x
 
+    def _extend(self, length):
+        if length <= self.positional_embedding.size(1):
+            return
+        table = self.positional_embedding
+        self.positional_embedding = _sinusoid_table(
+            length, self.embedding_dim, table.device).to(table.dtype).unsqueeze(0)
+
+
+class KVCache:
+    """
+    keys and values already projected by one RelativeGlobalAttention,
+    so incremental decoding only has to project the newest position.
+
+    With a window the cache is a ring buffer: once it is full, every new position
+    overwrites the oldest one in place. Relative attention only depends on distances,
+    so the remaining keys never have to be shifted or recomputed.
+    """
+    def __init__(self, window=None):
+        self.window = window
+        self.k = None
+        self.v = None
+        self._length = 0
+        self._start = 0  # slot of the oldest position
+
+    def __len__(self):
+        return self._length
+
+    def next_position(self):
+        """
+        :return: absolute position of the next token
+        """
+        if self.window is None:
+            return self._length
+        return min(self._length, self.window - 1)
+
+    def update(self, k, v):
+        """
+        :param k: new keys [batch, h, seq, dh]
+        :param v: new values [batch, h, seq, dh]
+        :return: keys and values of every cached position
+        """
+        if self.window is None:
+            if self.k is not None:
+                k = torch.cat([self.k, k], dim=2)
+                v = torch.cat([self.v, v], dim=2)
+            self.k, self.v = k, v
+            self._length = k.size(2)
+            return k, v
+
+        if self.k is None:
+            # prefill: the prior attends to all of itself, but only the latest window is kept.
+            n = min(k.size(2), self.window)
+            self.k = k.new_zeros(k.size(0), k.size(1), self.window, k.size(3))
+            self.v = v.new_zeros(v.size(0), v.size(1), self.window, v.size(3))
+            self.k[:, :, :n] = k[:, :, -n:]
+            self.v[:, :, :n] = v[:, :, -n:]
+            self._length = n
+            return k, v
+
+        for i in range(k.size(2)):
+            if self._length < self.window:
+                slot = self._length
+                self._length += 1
+            else:
+                slot = self._start
+                self._start = (self._start + 1) % self.window
+            self.k[:, :, slot] = k[:, :, i]
+            self.v[:, :, slot] = v[:, :, i]
+        return self.k[:, :, :self._length], self.v[:, :, :self._length]
+
+    def roll(self, tensor):
+        """
+        :param tensor: tensor whose last dim follows the keys from oldest to newest
+        :return: the same tensor in the slot order of the ring buffer
+        """
+        if self._start == 0:
+            return tensor
+        return torch.roll(tensor, self._start, -1)
+
 
 class RelativeGlobalAttention(torch.nn.Module):
     """
     from Music Transformer ( Huang et al, 2018 )
     [paper link](https://arxiv.org/pdf/1809.04281.pdf)
     """
-    def __init__(self, h=4, d=256, add_emb=False, max_seq=2048, **kwargs):
+    def __init__(self, h=4, d=256, add_emb=False, max_seq=2048, block_size=None, **kwargs):
         super().__init__()
         self.len_k = None
         self.max_seq = max_seq
+        self.block_size = block_size
         self.E = None
         self.h = h
         self.d = d
@@ -62,10 +148,11 @@ class RelativeGlobalAttention(torch.nn.Module):
         if self.additional:
             self.Radd = None
 
-    def forward(self, inputs, mask=None, **kwargs):
+    def forward(self, inputs, mask=None, cache=None, **kwargs):
         """
         :param inputs: a list of tensors. i.e) [Q, K, V]
         :param mask: mask tensor
+        :param cache: KVCache of the previous positions ( incremental decoding )
         :param kwargs:
         :return: final tensor ( output of attention )
         """
@@ -84,24 +171,39 @@ class RelativeGlobalAttention(torch.nn.Module):
         v = torch.reshape(v, (v.size(0), v.size(1), self.h, -1))
         v = v.permute(0, 2, 1, 3)
 
+        if cache is not None:
+            k, v = cache.update(k, v)
+
         self.len_k = k.size(2)
         self.len_q = q.size(2)
 
-        E = self._get_left_embedding(self.len_q, self.len_k).to(q.device)
-        QE = torch.einsum('bhld,md->bhlm', [q, E])
-        QE = self._qe_masking(QE)
-        Srel = self._skewing(QE)
-
-        Kt = k.permute(0, 1, 3, 2)
-        QKt = torch.matmul(q, Kt)
-        logits = QKt + Srel
-        logits = logits / math.sqrt(self.dh)
-
-        if mask is not None:
-            logits += (mask.to(torch.int64) * -1e9).to(logits.dtype)
-
-        attention_weights = F.softmax(logits, -1)
-        attention = torch.matmul(attention_weights, v)
+        if self.block_size is not None and self.block_size < self.len_q == self.len_k <= self.max_seq:
+            attention = self._blocked_attention(q, k, v, mask)
+            attention_weights = None
+        else:
+            E = self._get_left_embedding(self.len_q, self.len_k).to(q.device)
+            QE = torch.einsum('bhld,md->bhlm', [q, E])
+            if self.len_q == 1:
+                # a single query row attends every key, so QE is already aligned with them.
+                Srel = QE
+                if cache is not None:
+                    Srel = cache.roll(Srel)
+                    mask = cache.roll(mask) if mask is not None else None
+            else:
+                QE = self._qe_masking(QE)
+                Srel = self._skewing(QE)
+
+            Kt = k.permute(0, 1, 3, 2)
+            QKt = torch.matmul(q, Kt)
+            logits = QKt + Srel
+            logits = logits / math.sqrt(self.dh)
+
+            if mask is not None:
+                # the lowest value of the dtype: -1e9 overflows to -inf in float16
+                logits = logits.masked_fill(mask.to(torch.bool), torch.finfo(logits.dtype).min)
+
+            attention_weights = F.softmax(logits, -1)
+            attention = torch.matmul(attention_weights, v)
 
         out = attention.permute(0, 2, 1, 3)
         out = torch.reshape(out, (out.size(0), -1, self.d))
@@ -109,8 +211,36 @@ class RelativeGlobalAttention(torch.nn.Module):
         out = self.fc(out)
         return out, attention_weights
 
+    def _blocked_attention(self, q, k, v, mask):
+        """
+        same result as the dense path, computed for block_size query rows at a time,
+        so no [L, L] QE, Srel or logits tensor is ever materialised.
+        the attention weights are not kept either.
+        """
+        E = self._get_left_embedding(self.len_q, self.len_k).to(q.device)
+        Kt = k.permute(0, 1, 3, 2)
+        cols = torch.arange(self.len_k, device=q.device)
+        blocks = []
+        for start in range(0, self.len_q, self.block_size):
+            q_block = q[:, :, start:start + self.block_size]
+            rows = torch.arange(start, start + q_block.size(2), device=q.device).unsqueeze(-1)
+
+            # Srel[i, j] = QE[i, len_k-1-i+j] up to the diagonal and 0 above it, as _skewing gives.
+            QE = torch.einsum('bhld,md->bhlm', [q_block, E])
+            index = (self.len_k - 1 - rows + cols).clamp(max=self.len_k - 1)
+            Srel = QE.gather(-1, index.expand_as(QE)).masked_fill(cols > rows, 0)
+
+            logits = torch.matmul(q_block, Kt) + Srel
+            logits = logits / math.sqrt(self.dh)
+            if mask is not None:
+                block_mask = mask[..., start:start + q_block.size(2), :] if mask.size(-2) > 1 else mask
+                logits = logits.masked_fill(block_mask.to(torch.bool), torch.finfo(logits.dtype).min)
+
+            blocks.append(torch.matmul(F.softmax(logits, -1), v))
+        return torch.cat(blocks, dim=2)
+
     def _get_left_embedding(self, len_q, len_k):
-        starting_point = max(0,self.max_seq-len_q)
+        starting_point = max(0,self.max_seq-len_k)
         e = self.E[starting_point:,:]
         return e
 
@@ -127,19 +257,23 @@ class RelativeGlobalAttention(torch.nn.Module):
 
     @staticmethod
     def _qe_masking(qe):
-        mask = utils.sequence_mask(
-            torch.arange(qe.size()[-1] - 1, qe.size()[-1] - qe.size()[-2] - 1, -1).to(qe.device),
-            qe.size()[-1])
-        mask = ~mask.to(mask.device)
-        return mask.to(qe.dtype) * qe
+        # query i keeps the keys j >= len_k - 1 - i. for n >= len_k that is the top right
+        # [len_q, len_k] corner of the [n, n] mask, so a single mask serves every length.
+        len_q, len_k = qe.size(-2), qe.size(-1)
+        def build(n):
+            positions = torch.arange(n, device=qe.device)
+            return positions.unsqueeze(0) < n - 1 - positions.unsqueeze(1)
+        mask = utils.cached_mask('qe', max(len_q, len_k), qe.device, build)
+        n = mask.size(-1)
+        return qe.masked_fill(mask[:len_q, n - len_k:], 0)
 
 
 class EncoderLayer(torch.nn.Module):
-    def __init__(self, d_model, rate=0.1, h=16, additional=False, max_seq=2048):
+    def __init__(self, d_model, rate=0.1, h=16, additional=False, max_seq=2048, block_size=None):
         super(EncoderLayer, self).__init__()
 
         self.d_model = d_model
-        self.rga = RelativeGlobalAttention(h=h, d=d_model, max_seq=max_seq, add_emb=additional)
+        self.rga = RelativeGlobalAttention(h=h, d=d_model, max_seq=max_seq, add_emb=additional, block_size=block_size)
 
         self.FFN_pre = torch.nn.Linear(self.d_model, self.d_model//2)
         self.FFN_suf = torch.nn.Linear(self.d_model//2, self.d_model)
@@ -150,8 +284,8 @@ class EncoderLayer(torch.nn.Module):
         self.dropout1 = torch.nn.Dropout(rate)
         self.dropout2 = torch.nn.Dropout(rate)
 
-    def forward(self, x, mask=None, **kwargs):
-        attn_out, w = self.rga([x,x,x], mask)
+    def forward(self, x, mask=None, cache=None, **kwargs):
+        attn_out, w = self.rga([x,x,x], mask, cache=cache)
         attn_out = self.dropout1(attn_out)
         out1 = self.layernorm1(attn_out+x)
 
@@ -206,33 +340,55 @@ class DecoderLayer(torch.nn.Module):
 
 
 class Encoder(torch.nn.Module):
-    def __init__(self, num_layers, d_model, input_vocab_size, rate=0.1, max_len=None):
+    def __init__(self, num_layers, d_model, input_vocab_size, rate=0.1, max_len=None, block_size=None,
+                 checkpoint_every=None):
+        """
+        :param checkpoint_every: in training, keep activations only at the input of every checkpoint_every layers
+                                 and recompute the layers in between during backward ( None: keep everything )
+        """
         super(Encoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        self.checkpoint_every = checkpoint_every
 
         self.embedding = torch.nn.Embedding(num_embeddings=input_vocab_size, embedding_dim=d_model)
         if True:
             self.pos_encoding = DynamicPositionEmbedding(self.d_model, max_seq=max_len)
 
         self.enc_layers = torch.nn.ModuleList(
-            [EncoderLayer(d_model, rate, h=self.d_model // 64, additional=False, max_seq=max_len)
+            [EncoderLayer(d_model, rate, h=self.d_model // 64, additional=False, max_seq=max_len, block_size=block_size)
              for _ in range(num_layers)])
         self.dropout = torch.nn.Dropout(rate)
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, cache=None, offset=None):
+        """
+        :param cache: list of KVCache ( one per layer ). x only holds the positions after the cached ones.
+        :param offset: position of x[:, 0] ( see DynamicPositionEmbedding ), derived from the cache if None
+        """
         weights = []
+        if offset is None:
+            offset = cache[0].next_position() if cache is not None else 0
         # adding embedding and position encoding.
         x = self.embedding(x.to(torch.long))  # (batch_size, input_seq_len, d_model)
         x *= math.sqrt(self.d_model)
-        x = self.pos_encoding(x)
+        x = self.pos_encoding(x, offset)
         x = self.dropout(x)
+        if self.checkpoint_every and self.training and cache is None and torch.is_grad_enabled():
+            for start in range(0, self.num_layers, self.checkpoint_every):
+                x = checkpoint(self._run_layers, x, mask, start, start + self.checkpoint_every, use_reentrant=False)
+            return x, [None] * self.num_layers
         for i in range(self.num_layers):
-            x, w = self.enc_layers[i](x, mask)
-            weights.append(w)
+            x, w = self.enc_layers[i](x, mask, cache=cache[i] if cache is not None else None)
+            # the attention weights are only looked at in evaluation, training does not hold on to them
+            weights.append(None if self.training else w)
         return x, weights # (batch_size, input_seq_len, d_model)
 
+    def _run_layers(self, x, mask, start, end):
+        for layer in self.enc_layers[start:end]:
+            x, _ = layer(x, mask)
+        return x
+
 
 # class MusicTransformerDataParallelCriterion(torch.nn.DataParallel):
 #     def forward(self, inputs, *targets, **kwargs):
@@ -16,8 +16,12 @@ class _Metric(torch.nn.Module):
 
 
 class Accuracy(_Metric):
-    def __init__(self):
+    def __init__(self, ignore_index=None):
+        """
+        :param ignore_index: target token left out of the accuracy, i.e) the pad token
+        """
         super().__init__()
+        self.ignore_index = ignore_index
 
     def forward(self, input: torch.Tensor, target: torch.Tensor):
         """
@@ -26,7 +30,10 @@ class Accuracy(_Metric):
         :return:
         """
         bool_acc = input.long() == target.long()
-        return bool_acc.sum().to(torch.float) / bool_acc.numel()
+        if self.ignore_index is None:
+            return bool_acc.sum().to(torch.float) / bool_acc.numel()
+        mask = target != self.ignore_index
+        return (bool_acc & mask).sum().to(torch.float) / mask.sum()
 
 
 class MockAccuracy(Accuracy):
@@ -38,8 +45,8 @@ class MockAccuracy(Accuracy):
 
 
 class CategoricalAccuracy(Accuracy):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, ignore_index=None):
+        super().__init__(ignore_index)
 
     def forward(self, input: torch.Tensor, target: torch.Tensor):
         """
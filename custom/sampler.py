@@ -0,0 +1,91 @@
+import torch
+
+
+class _Sampler(object):
+    def __call__(self, logits: torch.Tensor):
+        return self.sample(logits)
+
+    def sample(self, logits: torch.Tensor):
+        """
+        :param logits: [B, V]
+        :return: sampled event per row [B, 1]
+        """
+        raise NotImplementedError()
+
+
+class GreedySampler(_Sampler):
+    def sample(self, logits: torch.Tensor):
+        return logits.argmax(-1, keepdim=True)
+
+
+class TemperatureSampler(_Sampler):
+    def __init__(self, temperature=1.0):
+        super().__init__()
+        self.temperature = temperature
+
+    def sample(self, logits: torch.Tensor):
+        return self._multinomial(self._scale(logits))
+
+    def _scale(self, logits):
+        return logits if self.temperature == 1.0 else logits / self.temperature
+
+    @staticmethod
+    def _multinomial(logits):
+        return torch.multinomial(logits.softmax(-1), 1, True)
+
+
+class TopKSampler(TemperatureSampler):
+    def __init__(self, top_k, temperature=1.0):
+        super().__init__(temperature)
+        self.top_k = top_k
+
+    def sample(self, logits: torch.Tensor):
+        # sample among the k best events only, then map back to event indices.
+        values, indices = self._scale(logits).topk(min(self.top_k, logits.size(-1)), dim=-1)
+        return indices.gather(-1, self._multinomial(values))
+
+
+class TopPSampler(TemperatureSampler):
+    """
+    nucleus sampling ( Holtzman et al, 2019 )
+    [paper link](https://arxiv.org/abs/1904.09751)
+    """
+    def __init__(self, top_p, temperature=1.0):
+        super().__init__(temperature)
+        self.top_p = top_p
+
+    def sample(self, logits: torch.Tensor):
+        values, indices = self._scale(logits).sort(dim=-1, descending=True)
+        probs = values.softmax(-1)
+        # drop an event once the events ranked before it already cover top_p. the best one always stays.
+        outside = (probs.cumsum(-1) - probs) >= self.top_p
+        values = values.masked_fill(outside, float('-inf'))
+        return indices.gather(-1, self._multinomial(values))
+
+
+def get_sampler(config):
+    """
+    :param config: config with 'sampler' ( greedy, temperature, top_k, top_p ) and its parameters.
+                   temperature 0 samples greedily, whatever the sampler.
+    :return: sampler instance
+    """
+    name = config.get('sampler') or 'temperature'
+    temperature = config.get('temperature')
+    temperature = 1.0 if temperature is None else temperature
+    if temperature < 0:
+        raise ValueError('temperature must not be negative, got {}'.format(temperature))
+    top_k, top_p = config.get('top_k'), config.get('top_p')
+    if name == 'top_k' and (top_k is None or top_k < 1):
+        raise ValueError("sampler 'top_k' needs top_k of 1 or more, got {}".format(top_k))
+    if name == 'top_p' and (top_p is None or not 0 < top_p <= 1):
+        raise ValueError("sampler 'top_p' needs top_p in (0, 1], got {}".format(top_p))
+
+    if name == 'greedy' or (temperature == 0 and name in ('temperature', 'top_k', 'top_p')):
+        return GreedySampler()
+    elif name == 'temperature':
+        return TemperatureSampler(temperature)
+    elif name == 'top_k':
+        return TopKSampler(top_k, temperature)
+    elif name == 'top_p':
+        return TopPSampler(top_p, temperature)
+    raise ValueError("'{}' is not a valid sampler".format(name))
@@ -1,26 +1,136 @@
 import utils
+import itertools
+import multiprocessing
+import os
+from collections import OrderedDict
 import random
 import pickle
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from custom.config import config
-from midi_processor.processor import START_IDX
+
+# packed corpus: every token stream concatenated into one uint16 file, with the offsets of every stream.
+PACKED_TOKENS = 'tokens.bin'
+PACKED_OFFSETS = 'offsets.npy'
+PACKED_FILES = 'files.txt'
+
+
+class TokenCache:
+    """
+    LRU cache of token arrays, bounded by their total size in bytes.
+
+    every process keeps its own cache: DataLoader workers start from a copy of the main process cache
+    ( shared copy-on-write after warm_cache ) and their misses grow their own copy. max_bytes bounds
+    each process, so the loaded arrays take up to ( 1 + num_workers ) * max_bytes in total.
+    the hit, miss and eviction counters are shared, stats() sums them over every process.
+    """
+    _HITS, _MISSES, _EVICTIONS = range(3)
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._counters = multiprocessing.Array('q', 3)
+        self._arrays = OrderedDict()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    @property
+    def hits(self):
+        return self._counters[self._HITS]
+
+    @property
+    def misses(self):
+        return self._counters[self._MISSES]
+
+    @property
+    def evictions(self):
+        return self._counters[self._EVICTIONS]
+
+    def _count(self, counter):
+        with self._counters.get_lock():
+            self._counters[counter] += 1
+
+    def get(self, key, load):
+        """
+        :param load: called on a miss, returns the array for key
+        """
+        array = self._arrays.get(key)
+        if array is not None:
+            self._count(self._HITS)
+            self._arrays.move_to_end(key)
+            return array
+        self._count(self._MISSES)
+        array = load()
+        if array.nbytes <= self.max_bytes:
+            self._arrays[key] = array
+            self.bytes += array.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self._count(self._EVICTIONS)
+        return array
+
+    def stats(self):
+        """
+        :return: hits, misses and evictions of every process, bytes cached by this process
+        """
+        hits, misses, evictions = self._counters[:]
+        requests = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'bytes': self.bytes,
+            'hit_rate': hits / requests if requests else 0.,
+        }
+
 
 class Data:
-    def __init__(self, dir_path):
-        self.files = list(utils.find_files_by_extensions(dir_path, ['.pickle']))
+    def __init__(self, dir_path, cache_bytes=0):
+        """
+        :param cache_bytes: memory for loaded pickles, kept as uint16 arrays in an LRU cache ( 0: no cache ).
+                            the bound is per process, every DataLoader worker has its own cache.
+                            a packed corpus is never cached, it is read through the page cache already.
+        """
+        if os.path.exists(os.path.join(dir_path, PACKED_TOKENS)):
+            self._tokens = np.memmap(os.path.join(dir_path, PACKED_TOKENS), dtype=np.uint16, mode='r')
+            self._offsets = np.load(os.path.join(dir_path, PACKED_OFFSETS))
+            with open(os.path.join(dir_path, PACKED_FILES)) as f:
+                self.files = f.read().splitlines()
+            self._file_idx = {fname: i for i, fname in enumerate(self.files)}
+        else:
+            self._tokens = None
+            self.files = list(utils.find_files_by_extensions(dir_path, ['.pickle']))
         self.file_dict = {
             'train': self.files[:int(len(self.files) * 0.8)],
             'eval': self.files[int(len(self.files) * 0.8): int(len(self.files) * 0.9)],
             'test': self.files[int(len(self.files) * 0.9):],
         }
+        self.cache = TokenCache(cache_bytes) if cache_bytes and self._tokens is None else None
         self._seq_file_name_idx = 0
         self._seq_idx = 0
+        self._seq_data = None
         pass
 
     def __repr__(self):
         return '<class Data has "'+str(len(self.files))+'" files>'
 
+    def __getstate__(self):
+        # DataLoader workers reopen the memory map instead of receiving a pickled copy of the tokens
+        state = self.__dict__.copy()
+        if self._tokens is not None:
+            state['_tokens'] = self._tokens.filename
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._tokens, str):
+            self._tokens = np.memmap(self._tokens, dtype=np.uint16, mode='r')
+
     def batch(self, batch_size, length, mode='train'):
 
         batch_files = random.sample(self.file_dict[mode], k=batch_size)
@@ -29,14 +139,49 @@ class Data:
             self._get_seq(file, length)
             for file in batch_files
         ]
-        return np.array(batch_data)  # batch_size, seq_len
+        return np.array(batch_data, dtype=np.int64)  # batch_size, seq_len
     
-    def all_data(self, mode='train'):
-        final_data = []
-        for file in self.files:
-            final_data.extend(self._get_seq(file))
-            final_data.append(START_IDX['end_of_song'])
-        return final_data  # batch_size, seq_len
+    def all_data(self, mode='train', eos=None):
+        """
+        :return: every file of the split followed by eos ( default config.token_eos ), as one int64 array
+        """
+        chunks = list(self.iter_all_data(mode, eos=eos))
+        return np.concatenate(chunks, dtype=np.int64) if chunks else np.zeros(0, dtype=np.int64)
+
+    def iter_all_data(self, mode='train', chunk_size=2 ** 20, eos=None):
+        """
+        all_data in bounded memory.
+        :return: generator of uint16 chunks of chunk_size tokens, the last one shorter
+        """
+        eos = config.token_eos if eos is None else eos
+        chunk = np.empty(chunk_size, dtype=np.uint16)
+        filled = 0
+        for fname in self.file_dict[mode]:
+            data = np.append(self._get_seq(fname), eos)
+            pos = 0
+            while pos < len(data):
+                n = min(chunk_size - filled, len(data) - pos)
+                chunk[filled:filled + n] = data[pos:pos + n]
+                filled += n
+                pos += n
+                if filled == chunk_size:
+                    yield chunk
+                    chunk = np.empty(chunk_size, dtype=np.uint16)
+                    filled = 0
+        if filled:
+            yield chunk[:filled]
+
+    def save_all_data(self, file_path, mode='train', chunk_size=2 ** 20, eos=None):
+        """
+        writes all_data of the split to file_path as raw uint16, chunk by chunk.
+        :return: read-only np.memmap of the file
+        """
+        with open(file_path, 'wb') as f:
+            for chunk in self.iter_all_data(mode, chunk_size, eos):
+                chunk.tofile(f)
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=np.uint16)
+        return np.memmap(file_path, dtype=np.uint16, mode='r')
 
     def seq2seq_batch(self, batch_size, length, mode='train'):
         data = self.batch(batch_size, length * 2, mode)
@@ -56,36 +201,101 @@ class Data:
         y = data[:, 1:]
         return x, y
 
-    def random_sequential_batch(self, batch_size, length):
+    def random_sequential_batch(self, batch_size, length, stride=1):
+        """
+        windows of consecutive starts ( stride apart ) from randomly sampled files, the first files first.
+        when the batch_size sampled files are too short, the other files follow in random order.
+        :return: [batch_size, length] int64 array
+        """
         batch_files = random.sample(self.files, k=batch_size)
         batch_data = []
-        for i in range(batch_size):
-            data = self._get_seq(batch_files[i])
-            for j in range(len(data) - length):
-                batch_data.append(data[j:j+length])
-                if len(batch_data) == batch_size:
-                    return batch_data
-
-    def sequential_batch(self, batch_size, length):
+        num_windows = 0
+        for fname in itertools.chain(batch_files, self._other_files(batch_files)):
+            windows = self._windows(self._get_seq(fname), length, stride)[:batch_size - num_windows]
+            batch_data.append(windows)
+            num_windows += len(windows)
+            if num_windows == batch_size:
+                return np.concatenate(batch_data, dtype=np.int64)
+        raise ValueError('{} windows of length {} in the whole corpus, {} requested'.format(
+            num_windows, length, batch_size))
+
+    def _other_files(self, files):
+        """
+        :return: generator of the files not in files, in random order. shuffled on first use only.
+        """
+        files = set(files)
+        others = [fname for fname in self.files if fname not in files]
+        random.shuffle(others)
+        yield from others
+
+    def sequential_batch(self, batch_size, length, stride=1):
+        """
+        walks every file in order, window after window ( stride apart ), and carries on with the next call.
+        the current file stays loaded between calls.
+        :return: [batch_size, length] int64 array
+        """
         batch_data = []
-        data = self._get_seq(self.files[self._seq_file_name_idx])
+        num_windows = 0
+        while num_windows < batch_size:
+            if self._seq_data is None:
+                self._seq_data = self._get_seq(self.files[self._seq_file_name_idx])
+            windows = self._windows(self._seq_data, length, stride, self._seq_idx)[:batch_size - num_windows]
+            batch_data.append(windows)
+            num_windows += len(windows)
+            self._seq_idx += len(windows) * stride
+            if num_windows < batch_size:
+                self._seq_idx = 0
+                self._seq_data = None
+                self._seq_file_name_idx = self._seq_file_name_idx + 1
+                if self._seq_file_name_idx == len(self.files):
+                    self._seq_file_name_idx = 0
+                    print('iter intialized')
+        return np.concatenate(batch_data, dtype=np.int64)
+
+    @staticmethod
+    def _windows(data, length, stride=1, start=0):
+        """
+        :return: strided view of the windows starting at start, start + stride, ... below len(data) - length
+        """
+        data = np.asarray(data)
+        if len(data) <= length:
+            return np.empty((0, length), dtype=data.dtype)
+        return sliding_window_view(data, length)[start:len(data) - length:stride]
 
-        while len(batch_data) < batch_size:
-            while self._seq_idx < len(data) - length:
-                batch_data.append(data[self._seq_idx: self._seq_idx + length])
-                self._seq_idx += 1
-                if len(batch_data) == batch_size:
-                    return batch_data
+    def window_batch(self, windows):
+        """
+        :param windows: list of (file name, offset, number of tokens), as yielded by the samplers
+        :return: x, y with y shifted by one token, shorter windows padded with config.pad_token
+        """
+        max_length = max(num_tokens for _, _, num_tokens in windows)
+        data = np.empty((len(windows), max_length), dtype=np.int64)
+        for row, (fname, offset, num_tokens) in enumerate(windows):
+            data[row, :num_tokens] = self._load(fname)[offset:offset + num_tokens]
+            if num_tokens < max_length:
+                data[row, num_tokens:] = config.pad_token
+        return data[:, :-1], data[:, 1:]
 
-            self._seq_idx = 0
-            self._seq_file_name_idx = self._seq_file_name_idx + 1
-            if self._seq_file_name_idx == len(self.files):
-                self._seq_file_name_idx = 0
-                print('iter intialized')
+    def random_window_batch(self, batch_size, length, mode='eval'):
+        """
+        one random window of length + 1 tokens from each of batch_size randomly sampled files.
+        pieces shorter than that are taken whole and padded, as in the batches of LengthBucketSampler.
+        :return: x, y as window_batch
+        """
+        windows = []
+        for fname in random.sample(self.file_dict[mode], k=batch_size):
+            seq_length = self.seq_length(fname)
+            num_tokens = min(seq_length, length + 1)
+            windows.append((fname, random.randrange(seq_length - num_tokens + 1), num_tokens))
+        return self.window_batch(windows)
+
+    def seq_length(self, fname):
+        if self._tokens is not None:
+            i = self._file_idx[fname]
+            return int(self._offsets[i + 1] - self._offsets[i])
+        return len(self._load(fname))
 
     def _get_seq(self, fname, max_length=None):
-        with open(fname, 'rb') as f:
-            data = pickle.load(f)
+        data = self._load(fname)
         if max_length is not None:
             if max_length <= len(data):
                 start = random.randrange(0,len(data) - max_length)
@@ -97,6 +307,227 @@ class Data:
                 #     data = np.append(data, config.pad_token)
         return data
 
+    def _load(self, fname):
+        if self._tokens is not None:
+            # a view of the memory map, nothing is read until it is used
+            i = self._file_idx[fname]
+            return self._tokens[self._offsets[i]:self._offsets[i + 1]]
+        if self.cache is not None:
+            return self.cache.get(fname, lambda: self._unpickle(fname).astype(np.uint16))
+        return self._unpickle(fname)
+
+    @staticmethod
+    def _unpickle(fname):
+        with open(fname, 'rb') as f:
+            return np.asarray(pickle.load(f))
+
+    def warm_cache(self, mode='train'):
+        """
+        fills the cache with the files of a split, up to its size. called before DataLoader workers
+        are forked, the workers share the cached arrays copy-on-write instead of loading their own.
+        """
+        if self.cache is None:
+            return
+        evictions = self.cache.evictions
+        for fname in self.file_dict[mode]:
+            self._load(fname)
+            if self.cache.evictions > evictions:
+                # full, the first cached file just made room for this one
+                break
+
+
+def pack_pickles(pickle_dir, packed_dir):
+    """
+    converts a directory of preprocessed pickles into a packed corpus that Data opens with np.memmap.
+    the file order is kept, so are the train / eval / test splits.
+    """
+    files = list(utils.find_files_by_extensions(pickle_dir, ['.pickle']))
+    os.makedirs(packed_dir, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(packed_dir, PACKED_TOKENS), 'wb') as f:
+        for fname in files:
+            with open(fname, 'rb') as pf:
+                data = np.asarray(pickle.load(pf))
+            assert data.size == 0 or (data.min() >= 0 and data.max() <= np.iinfo(np.uint16).max)
+            data.astype(np.uint16).tofile(f)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(packed_dir, PACKED_OFFSETS), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(packed_dir, PACKED_FILES), 'w') as f:
+        f.write('\n'.join(files))
+    return len(files), offsets[-1]
+
+
+class _EpochSampler(Sampler):
+    """
+    seeded per-epoch order, sharded across ranks, resumable from (epoch, cursor).
+    """
+    def __init__(self, seed=0, rank=0, world_size=1):
+        super().__init__()
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.cursor = 0
+
+    def _rng(self):
+        return np.random.default_rng([self.seed, self.epoch])
+
+    def set_epoch(self, epoch, cursor=0):
+        self.epoch = epoch
+        self.cursor = cursor
+
+    def state_dict(self, epoch, cursor):
+        """
+        the loader prefetches ahead of the training loop, so the caller passes the batches it actually consumed.
+        """
+        return {'seed': self.seed, 'epoch': epoch, 'cursor': cursor}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['cursor'])
+
+
+class WindowSampler(_EpochSampler):
+    """
+    every window of length + 1 tokens that fits in a file of the split, at a fixed stride.
+    the windows are shuffled per epoch from the seed and sharded across ranks;
+    each item is one batch, a list of (file name, offset, number of tokens).
+    """
+    def __init__(self, dataset, batch_size, length, mode='train', stride=None, seed=0, rank=0, world_size=1):
+        super().__init__(seed, rank, world_size)
+        self.file_names = dataset.file_dict[mode]
+        self.batch_size = batch_size
+        self.length = length
+
+        window = length + 1
+        stride = stride or window
+        files, offsets = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)]
+        for i, fname in enumerate(self.file_names):
+            starts = np.arange(0, dataset.seq_length(fname) - window + 1, stride, dtype=np.int64)
+            files.append(np.full(len(starts), i, dtype=np.int32))
+            offsets.append(starts)
+        self._files = np.concatenate(files)
+        self._offsets = np.concatenate(offsets)
+
+    def __len__(self):
+        # batches per epoch on each rank, every rank runs the same number of steps
+        return len(self._files) // self.world_size // self.batch_size
+
+    def __iter__(self):
+        order = self._rng().permutation(len(self._files))
+        order = order[:len(self) * self.batch_size * self.world_size][self.rank::self.world_size]
+        for b in range(self.cursor, len(self)):
+            batch = order[b * self.batch_size:(b + 1) * self.batch_size]
+            yield [(self.file_names[self._files[i]], int(self._offsets[i]), self.length + 1) for i in batch]
+
+
+class LengthBucketSampler(_EpochSampler):
+    """
+    variable-length sequences batched by a token budget.
+    every file is cut into sequences of at most max_length + 1 tokens, the remainder included,
+    so pieces shorter than max_length are used too. sequences of similar length share a batch
+    and a batch holds at most batch_tokens input tokens, padding included.
+    each item is one batch, a list of (file name, offset, number of tokens).
+    """
+    def __init__(self, dataset, batch_tokens, max_length, mode='train', min_length=2,
+                 seed=0, rank=0, world_size=1):
+        super().__init__(seed, rank, world_size)
+        self.file_names = dataset.file_dict[mode]
+        self.batch_tokens = batch_tokens
+        self.length = max_length
+
+        window = max_length + 1
+        files, offsets, lengths = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for i, fname in enumerate(self.file_names):
+            seq_length = dataset.seq_length(fname)
+            starts = np.arange(0, seq_length, window, dtype=np.int64)
+            seq_lengths = np.minimum(window, seq_length - starts)
+            # min_length input tokens, plus the shifted target
+            keep = seq_lengths > min_length
+            files.append(np.full(keep.sum(), i, dtype=np.int32))
+            offsets.append(starts[keep])
+            lengths.append(seq_lengths[keep])
+        self._files = np.concatenate(files)
+        self._offsets = np.concatenate(offsets)
+        self._lengths = np.concatenate(lengths)
+
+        # batch boundaries over the sequences sorted by length. they only depend on the sorted lengths,
+        # so every epoch has the same batches up to the order of sequences of equal length.
+        sorted_lengths = np.sort(self._lengths) - 1
+        self._bounds = [0]
+        for i, seq_length in enumerate(sorted_lengths):
+            if i > self._bounds[-1] and (i - self._bounds[-1] + 1) * seq_length > batch_tokens:
+                self._bounds.append(i)
+        if len(sorted_lengths):
+            self._bounds.append(len(sorted_lengths))
+
+    def __len__(self):
+        return (len(self._bounds) - 1) // self.world_size
+
+    def __iter__(self):
+        rng = self._rng()
+        order = rng.permutation(len(self._files))
+        order = order[np.argsort(self._lengths[order], kind='stable')]
+        batches = rng.permutation(len(self._bounds) - 1)
+        batches = batches[:len(self) * self.world_size][self.rank::self.world_size]
+        for b in batches[self.cursor:]:
+            batch = order[self._bounds[b]:self._bounds[b + 1]]
+            yield [(self.file_names[self._files[i]], int(self._offsets[i]), int(self._lengths[i])) for i in batch]
+
+    def padding_ratio(self):
+        """
+        share of padding in the input tokens of an epoch.
+        """
+        sorted_lengths = np.sort(self._lengths) - 1
+        padded = sum((end - start) * sorted_lengths[end - 1] for start, end in zip(self._bounds[:-1], self._bounds[1:]))
+        return 1 - sorted_lengths.sum() / max(padded, 1)
+
+
+def build_sampler(dataset, config, rank=0, world_size=1):
+    """
+    :param config: config with batch_size, max_seq and optionally batch_tokens, window_stride, seed
+    :return: LengthBucketSampler if batch_tokens is set, else WindowSampler
+    """
+    seed = config.get('seed') or 0
+    if config.get('batch_tokens'):
+        return LengthBucketSampler(
+            dataset, config.batch_tokens, config.max_seq, seed=seed, rank=rank, world_size=world_size)
+    return WindowSampler(
+        dataset, config.batch_size, config.max_seq,
+        stride=config.get('window_stride'), seed=seed, rank=rank, world_size=world_size)
+
+
+class WindowBatches(Dataset):
+    """
+    map-style view of Data for the samplers: a batch of windows -> (x, y) int64 tensors.
+    """
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+
+    def __getitem__(self, windows):
+        x, y = self.dataset.window_batch(windows)
+        return torch.from_numpy(x), torch.from_numpy(y)
+
+
+def batch_loader(dataset, sampler, num_workers=0, prefetch_factor=2, pin_memory=False):
+    """
+    :param dataset: Data
+    :param sampler: WindowSampler or LengthBucketSampler
+    :param num_workers: worker processes building batches, 0 builds them in the main process
+    :param prefetch_factor: batches each worker keeps ready
+    :param pin_memory: page-lock the batches, for non_blocking copies to cuda
+    :return: DataLoader yielding (x, y) int64 tensors, [batch_size, length]
+    """
+    return DataLoader(
+        WindowBatches(dataset),
+        sampler=sampler,
+        batch_size=None,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=pin_memory,
+        persistent_workers=num_workers > 0)
+
 
 class PositionalY:
     def __init__(self, data, idx):
@@ -34,7 +34,8 @@ mt = MusicTransformer(
     num_layer=config.num_layers,
     max_seq=config.max_seq,
     dropout=0,
-    debug=False)
+    debug=False,
+    attention_block=config.get('attention_block'))
 mt.load_state_dict(torch.load(args.model_dir+'/final.pth'))
 mt.test()
 
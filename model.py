@@ -2,10 +2,11 @@ from custom.layers import *
 from custom.criterion import *
 from custom.layers import Encoder
 from custom.config import config
+from custom.sampler import get_sampler
+from midi_processor.processor import NoteStreamDecoder
 
 import sys
 import torch
-import torch.distributions as dist
 import random
 import utils
 
@@ -16,7 +17,8 @@ from progress.bar import Bar
 
 class MusicTransformer(torch.nn.Module):
     def __init__(self, embedding_dim=256, vocab_size=388+2, num_layer=6,
-                 max_seq=2048, dropout=0.2, debug=False, loader_path=None, dist=False, writer=None):
+                 max_seq=2048, dropout=0.2, debug=False, loader_path=None, dist=False, writer=None,
+                 attention_block=None, checkpoint_every=None):
         super().__init__()
         self.infer = False
         if loader_path is not None:
@@ -32,54 +34,124 @@ class MusicTransformer(torch.nn.Module):
         self.writer = writer
         self.Decoder = Encoder(
             num_layers=self.num_layer, d_model=self.embedding_dim,
-            input_vocab_size=self.vocab_size, rate=dropout, max_len=max_seq)
+            input_vocab_size=self.vocab_size, rate=dropout, max_len=max_seq, block_size=attention_block,
+            checkpoint_every=checkpoint_every)
         self.fc = torch.nn.Linear(self.embedding_dim, self.vocab_size)
 
     def forward(self, x, length=None, writer=None):
         if self.training or not self.infer:
-            _, _, look_ahead_mask = utils.get_masked_with_pad_tensor(self.max_seq, x, x, config.pad_token)
+            _, _, look_ahead_mask = utils.get_masked_with_pad_tensor(x.size(1), x, x, config.pad_token)
             decoder, w = self.Decoder(x, mask=look_ahead_mask)
             fc = self.fc(decoder)
-            return fc.contiguous() if self.training else (fc.contiguous(), [weight.contiguous() for weight in w])
+            return fc.contiguous() if self.training else (fc.contiguous(), [weight.contiguous() for weight in w if weight is not None])
         else:
             return self.generate(x, length, None).contiguous().tolist()
 
     def generate(self,
                  prior: torch.Tensor,
                  length=2048,
-                 tf_board_writer: SummaryWriter = None):
+                 tf_board_writer: SummaryWriter = None,
+                 use_cache=True,
+                 sampler=None):
+        return self._generate(prior, length, tf_board_writer, use_cache, sampler=sampler)[0]
+
+    def generate_batch(self, priors, length=2048, use_cache=True, sampler=None):
+        """
+        :param priors: list of variable-length event lists
+        :param length: number of events generated for every row
+        :param sampler: custom.sampler instance, built from config if None
+        :return: list of event lists ( prior + generated events ), one per row
+        """
+        max_len = max(len(prior) for prior in priors)
+        pad = [max_len - len(prior) for prior in priors]
+        decode_array = torch.tensor(
+            [[config.pad_token] * n + list(prior) for n, prior in zip(pad, priors)], dtype=torch.long)
+        result_array = self._generate(decode_array, length, None, use_cache, torch.tensor(pad), sampler)
+        return [row[n:].tolist() for row, n in zip(result_array, pad)]
+
+    def generate_stream(self, prior, length=2048, use_cache=True, sampler=None, decode=False):
+        """
+        yields every event as soon as it is sampled.
+        :param prior: [1, seq]
+        :param decode: also yield the notes each event completes, i.e) (event, [pretty_midi.Note, ...]).
+                       the notes completed inside the prior come with the first event.
+        """
+        decoder = None
+        if decode:
+            decoder = NoteStreamDecoder()
+            notes = [note for idx in prior[0].tolist() for note in decoder.feed(idx)]
+        for result in self._generate_steps(prior, length, None, use_cache, None, sampler):
+            event = result[0, 0].item()
+            if decoder is None:
+                yield event
+            else:
+                notes += decoder.feed(event)
+                yield event, notes
+                notes = []
+
+    def _generate(self, prior, length, tf_board_writer=None, use_cache=True, pad=None, sampler=None):
+        """
+        :param prior: [batch, seq]
+        :param pad: number of left pad tokens of every prior row, None if unpadded
+        :param sampler: custom.sampler instance, built from config if None
+        :return: [batch, seq + length]
+        """
+        steps = self._generate_steps(prior, length, tf_board_writer, use_cache, pad, sampler)
+        return torch.cat([prior] + list(steps), dim=-1)
+
+    @torch.no_grad()
+    def _generate_steps(self, prior, length, tf_board_writer, use_cache, pad, sampler):
+        """
+        :return: generator of the sampled events of every step ( [batch, 1] )
+        """
+        if sampler is None:
+            sampler = get_sampler(config)
         decode_array = prior
         result_array = prior
+        cache = None
+        window = config.get('cache_window')
         print(config)
         print(length)
         for i in Bar('generating').iter(range(length)):
             if decode_array.size(1) >= config.threshold_len:
                 decode_array = decode_array[:, 1:]
-            _, _, look_ahead_mask = \
-                utils.get_masked_with_pad_tensor(decode_array.size(1), decode_array, decode_array, pad_token=config.pad_token)
+                if window is None:
+                    # every absolute position has shifted, so the cached keys are stale.
+                    cache = None
+
+            offset = None
+            if pad is not None:
+                # real tokens start at position 0 on every row, whatever its padding.
+                pad_left = (pad - (result_array.size(1) - decode_array.size(1))).clamp(min=0)
+                offset = -pad_left
 
-            # result, _ = self.forward(decode_array, lookup_mask=look_ahead_mask)
-            # result, _ = decode_fn(decode_array, look_ahead_mask)
-            result, _ = self.Decoder(decode_array, None)
-            result = self.fc(result)
-            result = result.softmax(-1)
+            if cache is not None:
+                if pad is not None:
+                    if window is None:
+                        offset = offset + decode_array.size(1) - 1
+                    else:
+                        offset = (result_array.size(1) - 1 - pad).clamp(max=window - 1)
+                num_keys = len(cache[0]) + 1 if window is None else min(len(cache[0]) + 1, window)
+                key_pad_mask = result_array[:, -num_keys:] == config.pad_token
+                mask = key_pad_mask[:, None, None, :] if key_pad_mask.any() else None
+                result, _ = self.Decoder(decode_array[:, -1:], mask, cache=cache, offset=offset)
+            else:
+                _, _, look_ahead_mask = \
+                    utils.get_masked_with_pad_tensor(decode_array.size(1), decode_array, decode_array, pad_token=config.pad_token)
+                if use_cache:
+                    cache = [KVCache(window) for _ in range(self.num_layer)]
+                result, _ = self.Decoder(decode_array, look_ahead_mask, cache=cache, offset=offset)
+                del look_ahead_mask
+            # only the newest position is sampled, so the rest never goes through fc.
+            logits = self.fc(result[:, -1])
 
             if tf_board_writer:
-                tf_board_writer.add_image("logits", result, global_step=i)
+                tf_board_writer.add_image("logits", logits.softmax(-1).unsqueeze(0), global_step=i)
 
-            u = 0
-            if u > 1:
-                result = result[:, -1].argmax(-1).to(decode_array.dtype)
-                decode_array = torch.cat((decode_array, result.unsqueeze(-1)), -1)
-            else:
-                pdf = dist.OneHotCategorical(probs=result[:, -1])
-                result = pdf.sample().argmax(-1).unsqueeze(-1)
-                # result = torch.transpose(result, 1, 0).to(torch.int32)
-                decode_array = torch.cat((decode_array, result), dim=-1)
-                result_array = torch.cat((result_array, result), dim=-1)
-            del look_ahead_mask
-        result_array = result_array[0]
-        return result_array
+            result = sampler(logits).to(decode_array.dtype)
+            decode_array = torch.cat((decode_array, result), dim=-1)
+            result_array = torch.cat((result_array, result), dim=-1)
+            yield result
 
     def test(self):
         self.eval()
@@ -1,3 +1,7 @@
+import argparse
+import bisect
+import json
+import multiprocessing
 import pickle
 import os
 import sys
@@ -7,83 +11,194 @@ import numpy as np
 from midi_processor.processor import encode_midi
 from midi_processor.processor import Event, _event_seq2snote_seq, _merge_note, encode_midi, decode_midi, START_IDX
 from custom.config import config
+from data import pack_pickles
 
 
 def preprocess_midi(path):
     return encode_midi(path)
 
 def filter_note_on_events(temp_data):
-    current_note_on_events = []
-    current_note_off_events = []
-    temp_events = []
-    filtered_events = []         # The final list of events (filtered and non-filtered)
-    time_shift_total = 0
-
-    for idx in temp_data:
-        # Check if the event is a 'note_on' or 'note_off' event
-        if idx in np.arange(START_IDX['note_on'], START_IDX['note_off']):
-            current_note_on_events.append(idx)
-
-        elif idx in np.arange(START_IDX['note_off'], START_IDX['time_shift']):
-            current_note_off_events.append(idx)
-
-        if idx not in np.arange(START_IDX['time_shift'], START_IDX['velocity']):
-            temp_events.append(idx)
-
-        # Check if the event is a 'time_shift' event (or indicates the end of the group)
-        else:
-            time_shift_total += idx - START_IDX['time_shift']
-            # Process current_note_on_events before a time shift event
-            if current_note_on_events and time_shift_total >= 5:
-                average_note_on = np.mean(current_note_on_events)  # Calculate average
-                # Filter note_on events that are above the average
-                filtered_notes = [note for note in temp_events if note > average_note_on - 1]
-                filtered_events.extend(filtered_notes)  # Add filtered note_on events to final list
-                current_note_on_events = []  # Reset for the next group of note_on events
-                temp_events = []
-                time_shift_total = 0
-
-            elif current_note_on_events:
-                temp_events.append(idx)
-
-            # Add the time_shift event itself to the filtered list
-            # filtered_events.append(idx)
-
-    # Edge case: Handle remaining note_on events if no final time_shift is present
-    if current_note_on_events:
-        average_note_on = np.mean(current_note_on_events)
-        filtered_note_on = [note for note in current_note_on_events if note > average_note_on]
-        filtered_events.extend(filtered_note_on)
-
-    return filtered_events
-
-def preprocess_midi_files_under(midi_folder, preprocess_folder):
+    """
+    melody extraction: events are grouped up to the time shift that brings the time since the last group
+    to 5 or more, once the group has a note_on. a group keeps its events except the note_on events below
+    its note_on average minus one; time shifts before the group's first note_on and the closing time shift
+    are dropped. after the last group only the note_on events above their average are kept.
+    :param temp_data: event indices
+    :return: filtered event list
+    """
+    idx = np.asarray(temp_data, dtype=np.int64)
+    positions = np.arange(len(idx))
+    is_on = (START_IDX['note_on'] <= idx) & (idx < START_IDX['note_off'])
+    is_shift = (START_IDX['time_shift'] <= idx) & (idx < START_IDX['velocity'])
+    shift_total = np.cumsum(np.where(is_shift, idx - START_IDX['time_shift'], 0)).tolist()
+    on_pos = np.flatnonzero(is_on).tolist()
+    shift_pos = np.flatnonzero(is_shift).tolist()
+
+    # group boundaries depend on the previous boundary, found by binary search per group
+    flushes, first_ons = [], []
+    flush = -1
+    while True:
+        k = bisect.bisect_right(on_pos, flush)
+        if k == len(on_pos):
+            break
+        first_on = on_pos[k]
+        reach = bisect.bisect_left(shift_total, (shift_total[flush] if flush >= 0 else 0) + 5)
+        s = bisect.bisect_left(shift_pos, max(reach, first_on))
+        first_ons.append(first_on)
+        if s == len(shift_pos):
+            break
+        flush = shift_pos[s]
+        flushes.append(flush)
+
+    # per group note_on averages, the last group is the tail after the last flush
+    group = np.searchsorted(flushes, positions)
+    num_groups = len(flushes) + 1
+    on_sum = np.bincount(group[is_on], weights=idx[is_on], minlength=num_groups)
+    on_count = np.bincount(group[is_on], minlength=num_groups)
+    average = np.divide(on_sum, on_count, out=np.zeros(num_groups), where=on_count > 0)[group]
+    first_on = np.array(first_ons + [len(idx)] * (num_groups - len(first_ons)))[group]
+
+    keep = np.where(is_on, idx > average - 1, ~is_shift | (positions > first_on))
+    keep[flushes] = False
+    tail = group == len(flushes)
+    keep[tail] = is_on[tail] & (idx[tail] > average[tail])
+    return idx[keep].tolist()
+
+
+MANIFEST = 'manifest.json'
+
+
+def _preprocess_one(args):
+    """
+    worker task: encodes one midi file and writes its pickle.
+    :return: (path, error message or None)
+    """
+    path, pickle_path, min_length, melody = args
+    try:
+        data = preprocess_midi(path)
+        if melody:
+            data = filter_note_on_events(data)
+        if len(data) >= min_length:
+            os.makedirs(os.path.dirname(pickle_path), exist_ok=True)
+            with open(pickle_path, 'wb') as f:
+                pickle.dump(data, f)
+        elif os.path.exists(pickle_path):
+            # kept by an earlier run with other options
+            os.remove(pickle_path)
+    except Exception as e:
+        return path, '{}: {}'.format(type(e).__name__, e)
+    return path, None
+
+
+def _pickle_path(path, midi_folder, preprocess_folder):
+    """
+    the pickle of a midi file keeps its path below midi_folder, so files of the same name
+    in different subdirectories never share a pickle.
+    """
+    return os.path.join(preprocess_folder, os.path.relpath(path, midi_folder)) + '.pickle'
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def _load_manifest(preprocess_folder, options):
+    """
+    :param options: the options that change the output, a manifest written with other options is discarded
+    :return: {path: stamp} of the inputs already done
+    """
+    manifest_path = os.path.join(preprocess_folder, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('options') != options:
+        return {}
+    return manifest['files']
+
+
+def _save_manifest(preprocess_folder, options, files):
+    manifest_path = os.path.join(preprocess_folder, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'options': options, 'files': files}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def preprocess_midi_files_under(midi_folder, preprocess_folder, num_workers=1, chunksize=16, save_every=1000,
+                                min_length=None, melody=False):
+    """
+    encodes every midi file under midi_folder into preprocess_folder, with num_workers processes.
+    the pickles mirror the subdirectories of midi_folder.
+    pieces shorter than min_length events ( default config.max_seq + 1 ) are left out.
+    with melody set, the events go through filter_note_on_events first.
+    finished inputs are recorded in a manifest ( path, mtime, size ), so a re-run only does what is left.
+    the manifest also records min_length and melody, changing either re-encodes every file.
+    a file that fails is reported at the end and retried on the next run.
+    :return: list of (path, error message)
+    """
     config.load('config', ['config/full.yml'])
     midi_paths = list(utils.find_files_by_extensions(midi_folder, ['.mid', '.midi']))
     os.makedirs(midi_folder, exist_ok=True)
     os.makedirs(preprocess_folder, exist_ok=True)
 
-    for path in Bar('Processing').iter(midi_paths):
-        print(' ', end='[{}]'.format(path), flush=True)
+    min_length = config.max_seq + 1 if min_length is None else min_length
+    options = {'min_length': min_length, 'melody': melody}
+    manifest = _load_manifest(preprocess_folder, options)
+    stamps = {path: _file_stamp(path) for path in midi_paths}
+    todo = [path for path in midi_paths if manifest.get(path) != stamps[path]]
+    print('{} files, {} already done'.format(len(midi_paths), len(midi_paths) - len(todo)))
+
+    tasks = [(path, _pickle_path(path, midi_folder, preprocess_folder), min_length, melody) for path in todo]
+    failures = []
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    results = pool.imap_unordered(_preprocess_one, tasks, chunksize) if pool else map(_preprocess_one, tasks)
+    bar = Bar('Processing', max=len(tasks))
+    try:
+        for i, (path, error) in enumerate(results):
+            if error is None:
+                manifest[path] = stamps[path]
+            else:
+                failures.append((path, error))
+            if (i + 1) % save_every == 0:
+                _save_manifest(preprocess_folder, options, manifest)
+            bar.next()
+    except KeyboardInterrupt:
+        print(' Abort')
+    finally:
+        bar.finish()
+        if pool:
+            pool.terminate()
+        _save_manifest(preprocess_folder, options, manifest)
+
+    if failures:
+        print('{} files failed:'.format(len(failures)))
+        for path, error in failures:
+            print('  {}: {}'.format(path, error))
+    return failures
 
-        try:
-            data = preprocess_midi(path)
-            if len(data) <= config.max_seq:
-                continue
-        except KeyboardInterrupt:
-            print(' Abort')
-            return
-        except EOFError:
-            print('EOF Error')
-            return
-
-        file_name = os.path.split(path)[1]
-        new_path = os.path.join(preprocess_folder, file_name)
-
-        with open(new_path + '.pickle', 'wb') as f:
-            pickle.dump(data, f)
 
 if __name__ == '__main__':
-    preprocess_midi_files_under(
-            midi_folder=sys.argv[1],
-            preprocess_folder=sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir', help='midi directory ( pickle directory with --pack )')
+    parser.add_argument('output_dir')
+    parser.add_argument('--pack', action='store_true',
+                        help='convert preprocessed pickles into a packed corpus ( see data.pack_pickles )')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=16, help='files handed to a worker at a time')
+    parser.add_argument('--min_length', type=int, default=None,
+                        help='shortest piece kept, default max_seq + 1 ( lower it for batch_tokens training )')
+    parser.add_argument('--melody', action='store_true', help='keep only the melody ( filter_note_on_events )')
+    args = parser.parse_args()
+
+    if args.pack:
+        num_files, num_tokens = pack_pickles(args.input_dir, args.output_dir)
+        print('packed {} files, {} tokens'.format(num_files, num_tokens))
+    else:
+        preprocess_midi_files_under(
+                midi_folder=args.input_dir,
+                preprocess_folder=args.output_dir,
+                num_workers=args.workers,
+                chunksize=args.chunksize,
+                min_length=args.min_length,
+                melody=args.melody)
@@ -1,3 +1,4 @@
+import numpy as np
 import pretty_midi
 
 
@@ -53,7 +54,31 @@ class SplitNote:
             .format(self.time, self.type, self.value, self.velocity)
 
 
+EVENT_TYPES = ('note_on', 'note_off', 'time_shift', 'velocity')
+_TYPE_BOUNDS = np.array([START_IDX['note_off'], START_IDX['time_shift'], START_IDX['velocity']])
+_START = np.array([START_IDX[t] for t in EVENT_TYPES])
+# token -> (type, value) for every token of the event vocabulary
+_EVENT_TABLE = [(t, idx - START_IDX[t])
+                for t, size in zip(EVENT_TYPES, [RANGE_NOTE_ON, RANGE_NOTE_OFF, RANGE_TIME_SHIFT, RANGE_VEL])
+                for idx in range(START_IDX[t], START_IDX[t] + size)]
+
+
+def classify_events(idx_array):
+    """
+    Event._type_check for a whole array.
+    :param idx_array: event indices
+    :return: type codes ( index into EVENT_TYPES ), values
+    """
+    idx = np.asarray(idx_array, dtype=np.int64)
+    types = np.searchsorted(_TYPE_BOUNDS, idx, side='right')
+    # anything outside the known ranges is a velocity, as in _type_check
+    types[idx < 0] = EVENT_TYPES.index('velocity')
+    return types, idx - _START[types]
+
+
 class Event:
+    __slots__ = ('type', 'value')
+
     def __init__(self, event_type, value):
         self.type = event_type
         self.value = value
@@ -66,28 +91,18 @@ class Event:
 
     @staticmethod
     def from_int(int_value):
-        info = Event._type_check(int_value)
-        return Event(info['type'], info['value'])
+        return Event(*Event._lookup(int_value))
 
     @staticmethod
     def _type_check(int_value):
-        range_note_on = range(0, RANGE_NOTE_ON)
-        range_note_off = range(RANGE_NOTE_ON, RANGE_NOTE_ON+RANGE_NOTE_OFF)
-        range_time_shift = range(RANGE_NOTE_ON+RANGE_NOTE_OFF,RANGE_NOTE_ON+RANGE_NOTE_OFF+RANGE_TIME_SHIFT)
-
-        valid_value = int_value
-
-        if int_value in range_note_on:
-            return {'type': 'note_on', 'value': valid_value}
-        elif int_value in range_note_off:
-            valid_value -= RANGE_NOTE_ON
-            return {'type': 'note_off', 'value': valid_value}
-        elif int_value in range_time_shift:
-            valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF)
-            return {'type': 'time_shift', 'value': valid_value}
-        else:
-            valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_TIME_SHIFT)
-            return {'type': 'velocity', 'value': valid_value}
+        event_type, value = Event._lookup(int_value)
+        return {'type': event_type, 'value': value}
+
+    @staticmethod
+    def _lookup(int_value):
+        if 0 <= int_value < len(_EVENT_TABLE):
+            return _EVENT_TABLE[int_value]
+        return 'velocity', int_value - START_IDX['velocity']
 
 
 def _divide_note(notes):
@@ -148,6 +163,40 @@ def _event_seq2snote_seq(event_sequence):
     return snote_seq
 
 
+class NoteStreamDecoder:
+    """
+    incremental version of _event_seq2snote_seq and _merge_note.
+    every note is returned as soon as its note_off event arrives.
+    """
+    def __init__(self):
+        self.timeline = 0
+        self.velocity = 0
+        self._note_on_dict = {}  # key: pitch, value: SplitNote
+
+    def feed(self, idx):
+        """
+        :param idx: event index
+        :return: list of notes completed by this event
+        """
+        event = Event.from_int(idx)
+        if event.type == 'time_shift':
+            self.timeline += ((event.value+1) / 100)
+        elif event.type == 'velocity':
+            self.velocity = event.value * 4
+        elif event.type == 'note_on':
+            self._note_on_dict[event.value] = SplitNote(event.type, self.timeline, event.value, self.velocity)
+        elif event.type == 'note_off':
+            try:
+                on = self._note_on_dict[event.value]
+            except KeyError:
+                print('info removed pitch: {}'.format(event.value))
+                return []
+            if self.timeline - on.time == 0:
+                return []
+            return [pretty_midi.Note(on.velocity, event.value, on.time, self.timeline)]
+        return []
+
+
 def _make_time_sift_events(prev_time, post_time):
     time_interval = int(round((post_time - prev_time) * 100))
     results = []
@@ -178,34 +227,106 @@ def _control_preprocess(ctrl_changes):
     return sustains
 
 
+def _first_greater(start):
+    """
+    :param start: note start times, in list order
+    :return: query(base, time) giving the first index >= base whose start is > time ( len(start) if none ),
+             in O(log n) from a table of range maxima
+    """
+    levels = [np.asarray(start, dtype=np.float64)]
+    while 2 ** len(levels) <= len(start):
+        prev, half = levels[-1], 2 ** (len(levels) - 1)
+        levels.append(np.maximum(prev[:-half], prev[half:]))
+    levels = [level.tolist() for level in levels]
+
+    def query(base, time):
+        pos = base
+        for k in reversed(range(len(levels))):
+            # levels[k][pos]: max start of notes[pos:pos + 2 ** k]
+            if pos < len(levels[k]) and levels[k][pos] <= time:
+                pos += 2 ** k
+        return pos
+    return query
+
+
 def _note_preprocess(susteins, notes):
-    note_stream = []
-
-    if susteins:    # if the midi file has sustain controls
-        for sustain in susteins:
-            for note_idx, note in enumerate(notes):
-                if note.start < sustain.start:
-                    note_stream.append(note)
-                elif note.start > sustain.end:
-                    notes = notes[note_idx:]
-                    sustain.transposition_notes()
-                    break
-                else:
-                    sustain.add_managed_note(note)
-
-        for sustain in susteins:
-            note_stream += sustain.managed_notes
-    
-    else:       # else, just push everything into note stream
-        for note_idx, note in enumerate(notes):
-            note_stream.append(note)
-
-    note_stream.sort(key= lambda x: x.start)
-    return note_stream
+    """
+    every sustain takes the notes from where the previous one stopped up to the first note starting after
+    the sustain ends: notes starting before the sustain go to the stream, the others are managed by it.
+    a sustain that finds no such note does not stop there, so the next one sees the same notes again.
+    notes after the last sustain that stopped are dropped.
+    """
+    if not susteins:    # just push everything into note stream
+        note_stream = list(notes)
+        note_stream.sort(key=lambda x: x.start)
+        return note_stream
+
+    start = np.array([note.start for note in notes], dtype=np.float64)
+    first_greater = _first_greater(start)
+    stream, managed = [], []
+    base = 0
+    for sustain in susteins:
+        end = first_greater(base, sustain.end)
+        window = np.arange(base, end)
+        before = start[base:end] < sustain.start
+        stream.append(window[before])
+        managed.append(window[~before])
+        for note_idx in managed[-1].tolist():
+            sustain.add_managed_note(notes[note_idx])
+        if end < len(notes):
+            sustain.transposition_notes()
+            base = end
+
+    note_idx = np.concatenate(stream + managed)
+    note_idx = note_idx[np.argsort(start[note_idx], kind='stable')]
+    return [notes[i] for i in note_idx.tolist()]
+
+
+def encode_note_arrays(start, end, pitch, velocity):
+    """
+    array version of _divide_note and the event loop of encode_midi, emitting the same tokens.
+    :param start: note on times ( seconds )
+    :param end: note off times ( seconds )
+    :param pitch: note pitches
+    :param velocity: note velocities
+    :return: int64 token array
+    """
+    start = np.asarray(start, dtype=np.float64)
+    order = np.argsort(start, kind='stable')
+    pitch = np.asarray(pitch, dtype=np.int64)[order]
+    velocity = np.asarray(velocity, dtype=np.int64)[order]
+
+    # split notes as _divide_note does: on, off, on, off ... then a stable sort by time
+    times = np.empty(2 * len(order))
+    times[0::2] = start[order]
+    times[1::2] = np.asarray(end, dtype=np.float64)[order]
+    events = np.argsort(times, kind='stable')
+    times = times[events]
+    is_on = events % 2 == 0
+    note = events // 2
+
+    # time shifts: full RANGE_TIME_SHIFT shifts, then the remainder if any
+    interval = np.round(np.diff(times, prepend=0.) * 100).astype(np.int64)
+    num_full, remainder = np.divmod(interval, RANGE_TIME_SHIFT)
+    num_shift = num_full + (remainder > 0)
+
+    # encode_midi compares the previous event's raw velocity ( None after a note_off, 0 at first )
+    # with the new velocity // 4, so -1 stands for None.
+    raw_velocity = np.where(is_on, velocity[note], -1)
+    modified_velocity = velocity[note] // 4
+    is_vel = is_on & (np.concatenate([[0], raw_velocity[:-1]]) != modified_velocity)
+
+    # every event writes: time shifts, an optional velocity, the note event
+    ends = np.cumsum(num_shift + is_vel + 1)
+    tokens = np.full(ends[-1] if len(ends) else 0, START_IDX['time_shift'] + RANGE_TIME_SHIFT - 1, dtype=np.int64)
+    tokens[ends - 1] = np.where(is_on, START_IDX['note_on'], START_IDX['note_off']) + pitch[note]
+    tokens[(ends - 2)[is_vel]] = START_IDX['velocity'] + modified_velocity[is_vel]
+    has_remainder = remainder > 0
+    tokens[(ends - 2 - is_vel)[has_remainder]] = START_IDX['time_shift'] + remainder[has_remainder] - 1
+    return tokens
 
 
 def encode_midi(file_path):
-    events = []
     notes = []
     mid = pretty_midi.PrettyMIDI(midi_file=file_path)
 
@@ -216,31 +337,61 @@ def encode_midi(file_path):
         ctrls = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
         notes += _note_preprocess(ctrls, inst_notes)
 
-    dnotes = _divide_note(notes)
-
-    # print(dnotes)
-    dnotes.sort(key=lambda x: x.time)
-    # print('sorted:')
-    # print(dnotes)
-    cur_time = 0
-    cur_vel = 0
-    for snote in dnotes:
-        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-        events += _snote2events(snote=snote, prev_vel=cur_vel)
-        # events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-
-        cur_time = snote.time
-        cur_vel = snote.velocity
-
-    return [e.to_int() for e in events]
+    return encode_note_arrays(
+        [note.start for note in notes],
+        [note.end for note in notes],
+        [note.pitch for note in notes],
+        [note.velocity for note in notes]).tolist()
+
+
+def decode_note_arrays(idx_array):
+    """
+    array version of _event_seq2snote_seq and _merge_note, pairing events the same way:
+    a note_off closes the latest note_on of its pitch, zero length notes are dropped.
+    :param idx_array: event indices
+    :return: start, end, pitch, velocity arrays, notes sorted by start
+    """
+    types, values = classify_events(idx_array)
+    positions = np.arange(len(types))
+    is_on = types == EVENT_TYPES.index('note_on')
+    is_off = types == EVENT_TYPES.index('note_off')
+    is_shift = types == EVENT_TYPES.index('time_shift')
+    is_vel = types == EVENT_TYPES.index('velocity')
+
+    # timeline: a sequential cumulative sum, the same additions as the event loop
+    timeline = np.cumsum(np.where(is_shift, (values + 1) / 100, 0.))
+    # velocity in effect at every event, 0 before the first velocity event
+    last_vel = np.maximum.accumulate(np.where(is_vel, positions, -1))
+    velocity = np.where(last_vel >= 0, values[last_vel] * 4, 0)
+
+    # group note events by pitch in time order, every note_off takes the latest note_on before it
+    note_pos = positions[is_on | is_off]
+    pitch = values[note_pos]
+    order = np.lexsort((note_pos, pitch))
+    note_pos, pitch = note_pos[order], pitch[order]
+    group_start = np.maximum.accumulate(np.where(np.diff(pitch, prepend=-1) != 0, np.arange(len(pitch)), 0))
+    last_on = np.maximum.accumulate(np.where(is_on[note_pos], np.arange(len(pitch)), -1))
+    off = is_off[note_pos]
+    matched = off & (last_on >= group_start)
+    for p in pitch[off & ~matched]:
+        print('info removed pitch: {}'.format(p))
+
+    off_pos = note_pos[matched]
+    on_pos = note_pos[last_on[matched]]
+    start, end = timeline[on_pos], timeline[off_pos]
+    keep = end - start != 0
+    # _merge_note emits notes in note_off order, decode_midi then sorts them stably by start
+    by_off = np.argsort(off_pos[keep], kind='stable')
+    start, end = start[keep][by_off], end[keep][by_off]
+    pitch, velocity = pitch[matched][keep][by_off], velocity[on_pos][keep][by_off]
+    by_start = np.argsort(start, kind='stable')
+    return start[by_start], end[by_start], pitch[by_start], velocity[by_start]
 
 
 def decode_midi(idx_array, file_path=None):
-    event_sequence = [Event.from_int(idx) for idx in idx_array]
-    # print(event_sequence)
-    snote_seq = _event_seq2snote_seq(event_sequence)
-    note_seq = _merge_note(snote_seq)
-    note_seq.sort(key=lambda x:x.start)
+    start, end, pitch, velocity = decode_note_arrays(idx_array)
+    note_seq = [pretty_midi.Note(v, p, s, e)
+                for s, e, p, v in zip(start.tolist(), end.tolist(), pitch.tolist(), velocity.tolist())]
 
     mid = pretty_midi.PrettyMIDI()
     # if want to change instument, see https://www.midi.org/specifications/item/gm-level-1-sound-set
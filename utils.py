@@ -55,24 +55,62 @@ def compute_gradient_norm(parameters, norm_type=2):
     return total_norm
 
 
+def get_amp_dtype(fp16, device):
+    """
+    :param fp16: config 'fp16': empty for float32, 'bf16' for bfloat16, true or 'fp16' for float16
+                 ( bfloat16 on cpu, where float16 autocast is not supported well )
+    :param device: training device
+    :return: torch.autocast dtype, None for float32
+    """
+    if not fp16:
+        return None
+    if fp16 == 'bf16' or device.type == 'cpu':
+        return torch.bfloat16
+    return torch.float16
+
+
+def save_checkpoint(path, sampler_state, **modules):
+    """
+    everything a run needs to resume: the state_dict of every module ( model, scheduler, scaler... )
+    and the sampler position. written next to path first, so an interrupted save keeps the last checkpoint.
+    :param sampler_state: sampler.state_dict(epoch, cursor) of the batches consumed so far
+    """
+    state = {name: module.state_dict() for name, module in modules.items()}
+    state['sampler'] = sampler_state
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, sampler, map_location=None, **modules):
+    """
+    restores a checkpoint of save_checkpoint, into the same modules and sampler.
+    """
+    state = torch.load(path, map_location=map_location)
+    for name, module in modules.items():
+        module.load_state_dict(state[name])
+    sampler.load_state_dict(state['sampler'])
+
+
 def get_masked_with_pad_tensor(size, src, trg, pad_token):
     """
     :param size: the size of target input
     :param src: source tensor
     :param trg: target tensor
     :param pad_token: pad token
-    :return:
+    :return: src_mask, trg_mask ( 0-d bool tensors, true if the whole source is padding ) and look_ahead_mask.
+             the 0-d masks are left on the device, reading them is up to the caller.
     """
     src = src[:, None, None, :]
-    trg = trg[:, None, None, :]
-    src_pad_tensor = torch.ones_like(src).to(src.device.type) * pad_token
-    src_mask = torch.equal(src, src_pad_tensor)
-    trg_mask = torch.equal(src, src_pad_tensor)
+    # i.e) torch.equal(src, pad tensor): the whole source is padding
+    src_mask = (src == pad_token).all()
+    trg_mask = src_mask
     if trg is not None:
-        trg_pad_tensor = torch.ones_like(trg).to(trg.device.type) * pad_token
-        dec_trg_mask = trg == trg_pad_tensor
+        trg = trg[:, None, None, :]
+        dec_trg_mask = trg == pad_token
         # boolean reversing i.e) True * -1 + 1 = False
-        seq_mask = ~sequence_mask(torch.arange(1, size+1).to(trg.device), size)
+        seq_mask = cached_mask(
+            'look_ahead', size, trg.device,
+            lambda n: ~sequence_mask(torch.arange(1, n+1).to(trg.device), n))[:size, :size]
         # look_ahead_mask = torch.max(dec_trg_mask, seq_mask)
         look_ahead_mask = dec_trg_mask | seq_mask
 
@@ -83,6 +121,23 @@ def get_masked_with_pad_tensor(size, src, trg, pad_token):
     return src_mask, trg_mask, look_ahead_mask
 
 
+_MASK_CACHE = {}
+
+
+def cached_mask(name, size, device, build):
+    """
+    one bool mask per name and device, shared by layers and steps. a smaller size is a slice of it,
+    so the cache never holds more than one mask of the longest size seen.
+    :param name: which mask, i.e) 'look_ahead'
+    :param build: function(n) building the [n, n] bool mask
+    :return: [n, n] bool mask with n >= size ( do not modify it in place )
+    """
+    mask = _MASK_CACHE.get((name, device))
+    if mask is None or mask.size(-1) < size:
+        mask = _MASK_CACHE[(name, device)] = build(size)
+    return mask
+
+
 def get_mask_tensor(size):
     """
     :param size: max length of token